@@ -0,0 +1,371 @@
+#! /usr/bin/env python
+"""
+Description
+===========
+
+This script benchmarks hgstats filters.
+
+Given repository paths, serial and parallel `DiffstatFilter` runs are
+compared. Diffstat cache is never used while benchmarking, so every
+run diffs all changesets.
+
+With ``--grouping`` option, `GroupingFilter` engine is benchmarked on
+synthetic timestamp streams.
+
+With ``--suite`` option, every filter, a set of pipespecs (see
+`SUITE_PIPESPECS`) and every output method are timed on each
+repository instead, along with every stage of pipespecs evaluated
+column-wise (that is, unfused). ``--synthetic`` option makes a reproducible
+repository of configured size to run the suite on (see
+`make_synthetic_repo`). Suite results may be saved to a JSON file and
+compared with results of a previous run to spot regressions.
+
+Author and licensing
+====================
+
+Copyright (C) 2009 Dmitry Dzhus <dima@sphinx.net.ru>
+
+This code is subject to GNU General Public License version 2, as can
+be read on <http://www.gnu.org/licenses/gpl-2.0.html>.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import getopt
+import tempfile
+
+from mercurial import hg, ui, context
+from mercurial.node import hex
+from mercurial.i18n import _
+from mercurial.fancyopts import fancyopts
+
+from helpers import get_repo_name
+from processing import RepoStream, DiffstatFilter, FrameGrouper, ColumnStream
+from pipespec import parse_pipespec, PlanSet
+from cache import FileDiffstatCache
+from instrument import profile_stages, profile_rows
+from output import PrintOutput, FileOutput, BinaryOutput, GchartOutput
+
+# Pipespecs timed by suite as a whole, diffstat cache is disabled in
+# all of them unless stated otherwise. Tuples are pipespecs evaluated
+# together, the last one being timed
+SUITE_PIPESPECS = ['DiffstatFilter(False,False)',
+                   'DiffstatFilter(False,True)',
+                   'DiffstatFilter(False,False)-AccFilter',
+                   'DiffstatFilter(False,False)-GroupingFilter(7,14)-AccFilter',
+                   'TagsFilter-DiffstatFilter(True,False)',
+                   'GroupingFilter(1,30)',
+                   'GroupingFilter(7,7,True,True)',
+                   'AccFilter-DownsampleFilter(600)',
+                   'DateFilter(10000)-AccFilter',
+                   'AuthorFilter',
+                   'DiffstatFilter(False,False)-AuthorFilter(30)',
+                   'PathChurnFilter',
+                   'HotPathsFilter',
+                   ('DiffstatFilter(False,False)-AccFilter', 'TagsFilter-DropFilter(1)')]
+
+# Pipespec used to time output methods
+OUTPUT_PIPESPEC = 'DiffstatFilter(False,True)-AccFilter'
+
+SUITE_OUTPUTS = [('print', PrintOutput), ('file', FileOutput),
+                 ('binary', BinaryOutput), ('gchart', GchartOutput)]
+
+# Results worse by more than that many times are reported as
+# regressions
+REGRESSION_RATIO = 1.1
+
+def timed(func, *args):
+    """
+    Return a tuple with wall time spent in `func` call (in seconds)
+    and its result.
+    """
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def collect_y(stream):
+    return [item.y for item in stream]
+
+def bench_diffstat(repo, workers):
+    """
+    Compare serial and parallel `DiffstatFilter` on `repo`.
+    """
+    serial_time, serial_res = timed(collect_y,
+                                    DiffstatFilter(RepoStream(repo), use_cache=False,
+                                                   workers=1))
+    parallel_time, parallel_res = timed(collect_y,
+                                        DiffstatFilter(RepoStream(repo), use_cache=False,
+                                                       workers=workers))
+    if serial_res != parallel_res:
+        print >> sys.stderr, 'Parallel results differ for %s!' % repo.root
+    print '%-20s %8d %10.2fs %10.2fs %8.2fx' % \
+          (get_repo_name(repo), len(serial_res), serial_time, parallel_time,
+           serial_time / max(parallel_time, 1e-6))
+
+def synthetic_timestamps(count, years=15):
+    """
+    Return a list of `count` ``(timestamp, y)`` tuples spread over
+    last `years` years with random gaps between timestamps, about 5%
+    of items being out of order.
+    """
+    rnd = random.Random(count)
+    mean_gap = years * 365 * 86400.0 / count
+    res = []
+    t = time.time() - years * 365 * 86400
+    for i in xrange(count):
+        t += rnd.expovariate(1.0 / mean_gap)
+        if rnd.random() < 0.05:
+            res.append((t - rnd.uniform(0, mean_gap * 48), 1))
+        else:
+            res.append((t, 1))
+    return res
+
+def bench_grouping(count):
+    """
+    Time `FrameGrouper` on `count` synthetic items with various
+    resolutions and relaxation periods.
+    """
+    pairs = synthetic_timestamps(count)
+    print '%10s %10s %8s %10s' % ('resolution', 'relax', 'frames', 'time')
+    for (resolution, relax_days) in [(1, 1), (1, 30), (7, 7), (30, 365)]:
+        grouper = FrameGrouper(resolution, relax_days)
+        frames_time, frames = timed(lambda: len(list(grouper.group(pairs))))
+        print '%10d %10d %8d %9.2fs' % (resolution, relax_days, frames, frames_time)
+
+def _changed_text(rnd, text):
+    """
+    Return `text` with a few lines replaced, removed and added.
+    """
+    lines = text.splitlines(True)
+    for i in xrange(rnd.randint(0, 3)):
+        if lines:
+            lines[rnd.randrange(len(lines))] = 'changed %d\n' % rnd.getrandbits(32)
+    for i in xrange(rnd.randint(0, 2)):
+        if lines:
+            del lines[rnd.randrange(len(lines))]
+    for i in xrange(rnd.randint(1, 8)):
+        lines.insert(rnd.randint(0, len(lines)), 'line %d\n' % rnd.getrandbits(32))
+    return ''.join(lines)
+
+def make_synthetic_repo(path, commits=1000, files=3, merge_percent=5,
+                        tag_percent=2, years=5, seed=0):
+    """
+    Create repository at `path` with `commits` changesets, each one
+    changing about `files` files.
+
+    Roughly `merge_percent` percents of changesets are merges, and as
+    many are made on top of older changesets to make heads to be
+    merged. Every `tag_percent` percents of changesets are tagged.
+    Changeset dates are spread over `years` years starting from
+    2009-01-01, sometimes going backwards as they do in real
+    repositories.
+
+    Same `seed` gives the same repository.
+    """
+    rnd = random.Random(seed)
+    repo = hg.repository(ui.ui(), path, create=True)
+    start = 1230768000
+    mean_gap = years * 365 * 86400.0 / max(commits, 1)
+    date = start
+    heads = [-1]
+    tags = ''
+    pool = ['file%d' % i for i in xrange(max(files * 4, 1))]
+    for i in xrange(commits):
+        choice = rnd.random() * 100
+        if choice < merge_percent and len(heads) > 1:
+            parents = [heads.pop(), heads.pop(rnd.randrange(len(heads)))]
+            changed = []
+        else:
+            if choice < 2 * merge_percent and len(repo):
+                # Start new head from one of recent changesets
+                parents = [rnd.randint(max(len(repo) - 20, 0), len(repo) - 1)]
+            else:
+                parents = [heads.pop()]
+            changed = rnd.sample(pool, min(rnd.randint(1, 2 * files), len(pool)))
+            if rnd.random() < 0.05:
+                pool.append('dir%d/file%d' % (i % 7, i))
+        if tag_percent and rnd.random() * 100 < tag_percent and len(repo):
+            tags += '%s tag%d\n' % (hex(repo.changelog.node(len(repo) - 1)), i)
+            changed.append('.hgtags')
+        parent_ctx = repo[parents[0]]
+        def filectx(repo, mctx, name):
+            if name == '.hgtags':
+                data = tags
+            else:
+                old = name in parent_ctx and parent_ctx[name].data() or ''
+                data = _changed_text(rnd, old)
+            return context.memfilectx(repo, name, data, memctx=mctx)
+        date += rnd.expovariate(1.0 / mean_gap)
+        if rnd.random() < 0.03:
+            commit_date = date - rnd.uniform(0, mean_gap * 10)
+        else:
+            commit_date = date
+        ctx = context.memctx(repo, ([repo.changelog.node(p) for p in parents] + [None])[:2],
+                             'commit %d' % i, changed, filectx,
+                             user='user%d <user%d@example.com>' % ((i % 5,) * 2),
+                             date=(int(commit_date), 0))
+        repo.commitctx(ctx)
+        heads.append(len(repo) - 1)
+    return repo
+
+def best_time(repeat, func, *args):
+    """
+    Return minimal wall time of `repeat` calls of `func`.
+    """
+    return min([timed(func, *args)[0] for i in xrange(repeat)])
+
+def suite_pipespec(repo, pipespec):
+    """
+    Return a tuple with total time of evaluating `pipespec` (or a
+    tuple of pipespecs, see `SUITE_PIPESPECS`) on `repo` and a list
+    of ``(stage, time)`` tuples with time spent in every stage of
+    them, starting with the source one. Stages are evaluated one by
+    one, so that each one is measured; those not evaluated on their
+    own (like `RepoStream` read directly by `TagsFilter`) have None
+    time.
+
+    Path filters always use file diffstat cache, so it's emptied
+    before evaluation.
+    """
+    if isinstance(pipespec, basestring):
+        pipespec = (pipespec,)
+    FileDiffstatCache.shared(repo, (), ()).data = {}
+    seen = set()
+    profiled = [profile_stages(s, seen=seen)
+                for s in PlanSet(map(parse_pipespec, pipespec))(repo)]
+    total, cols = timed(ColumnStream(profiled[-1][0]).columns)
+    profiles = []
+    for (s, chain) in profiled:
+        profiles.extend([p for p in chain if p not in profiles])
+    return total, [(row['stage'], row['calls'] and row['wall'] or None)
+                   for row in profile_rows(profiles)]
+
+def suite_outputs(repo, repeat):
+    """
+    Return a list of ``(method, time)`` tuples for all output methods
+    writing results of `OUTPUT_PIPESPEC` for `repo`.
+    """
+    s = ColumnStream(parse_pipespec(OUTPUT_PIPESPEC)(repo))
+    s.columns()
+    res = []
+    old_dir, old_stdout = os.getcwd(), sys.stdout
+    tmp_dir = tempfile.mkdtemp(prefix='hgstats-bench-')
+    try:
+        os.chdir(tmp_dir)
+        sys.stdout = open(os.devnull, 'w')
+        for (name, method) in SUITE_OUTPUTS:
+            res.append((name, best_time(repeat, method([(repo, s)], False))))
+    finally:
+        sys.stdout.close()
+        sys.stdout = old_stdout
+        os.chdir(old_dir)
+        shutil.rmtree(tmp_dir)
+    return res
+
+def run_suite(repo, repeat=3):
+    """
+    Run benchmark suite on `repo`, return a dictionary of timings
+    (minimal of `repeat` runs) in seconds.
+    """
+    name = get_repo_name(repo)
+    results = {}
+    for pipespec in SUITE_PIPESPECS:
+        runs = [suite_pipespec(repo, pipespec) for i in xrange(repeat)]
+        if not isinstance(pipespec, basestring):
+            pipespec = ' '.join(pipespec)
+        results['%s pipespec %s' % (name, pipespec)] = min([r[0] for r in runs])
+        for i, (stage, t) in enumerate(runs[0][1]):
+            if t is None:
+                continue
+            stage = stage != name and stage.rsplit('-', 1)[-1] or 'RepoStream'
+            key = '%s stage %d %s of %s' % (name, i, stage, pipespec)
+            results[key] = min([r[1][i][1] for r in runs])
+    for (method, t) in suite_outputs(repo, repeat):
+        results['%s output %s' % (name, method)] = t
+    return results
+
+def compare_results(old, new):
+    """
+    Print timings from `new` results dictionary next to `old` ones,
+    return a list of names of benchmarks which got slower more than
+    `REGRESSION_RATIO` times.
+    """
+    regressions = []
+    width = max(map(len, new) + [9])
+    print '%-*s %10s %10s %8s' % (width, 'benchmark', 'old', 'new', 'ratio')
+    for name in sorted(new):
+        if name not in old:
+            print '%-*s %10s %9.4fs' % (width, name, '', new[name])
+            continue
+        ratio = new[name] / max(old[name], 1e-6)
+        mark = ''
+        # Very short timings are too noisy to be compared
+        if ratio > REGRESSION_RATIO and new[name] > 0.001:
+            regressions.append(name)
+            mark = ' !'
+        print '%-*s %9.4fs %9.4fs %7.2fx%s' % (width, name, old[name], new[name],
+                                               ratio, mark)
+    return regressions
+
+def print_usage():
+    print(_("Usage: ./benchmark.py [OPTIONS] PATH1 [PATH2 [..]]"))
+
+options = {}
+
+optable = [
+    ('j', 'jobs', 4, _('Number of worker processes for parallel runs')),
+    ('g', 'grouping', 0, _('Benchmark grouping on that many synthetic items')),
+    ('s', 'suite', False, _('Time filters, pipespecs and output methods')),
+    ('r', 'repeat', 3, _('Take best time of that many suite runs')),
+    ('', 'synthetic', '', _('Make synthetic repository in this directory (unless it exists) and benchmark it')),
+    ('', 'commits', 1000, _('Number of changesets in synthetic repository')),
+    ('', 'files', 3, _('Average number of files changed by synthetic changesets')),
+    ('', 'merge-percent', 5, _('Percentage of merges in synthetic repository')),
+    ('', 'tag-percent', 2, _('Percentage of tagged changesets in synthetic repository')),
+    ('', 'years', 5, _('Years spanned by synthetic repository')),
+    ('', 'save', '', _('Save suite results to this JSON file')),
+    ('', 'compare', '', _('Compare suite results with those saved in this JSON file')),
+    ]
+
+if __name__ == '__main__':
+    try:
+        path_list = fancyopts(sys.argv[1:], optable, options)
+    except getopt.GetoptError:
+        print_usage()
+        exit()
+    if options['grouping']:
+        bench_grouping(options['grouping'])
+    if options['synthetic']:
+        if not os.path.exists(options['synthetic']):
+            make_synthetic_repo(options['synthetic'], options['commits'],
+                                options['files'], options['merge_percent'],
+                                options['tag_percent'], options['years'])
+        path_list.append(options['synthetic'])
+    if not path_list:
+        if not options['grouping']:
+            print_usage()
+        exit()
+    if options['suite']:
+        results = {}
+        for path in path_list:
+            results.update(run_suite(hg.repository(ui.ui(), path), options['repeat']))
+        if options['save']:
+            results_file = open(options['save'], 'w')
+            json.dump(results, results_file, indent=1, sort_keys=True)
+            results_file.close()
+        old = {}
+        if options['compare']:
+            old = json.load(open(options['compare']))
+        regressions = compare_results(old, results)
+        if regressions:
+            print '%d benchmarks got slower' % len(regressions)
+            sys.exit(1)
+        exit()
+    print '%-20s %8s %11s %11s %9s' % ('repo', 'items', 'serial',
+                                       'parallel(%d)' % options['jobs'], 'speedup')
+    for path in path_list:
+        bench_diffstat(hg.repository(ui.ui(), path), options['jobs'])
@@ -0,0 +1,122 @@
+"""
+Description
+===========
+
+Binary columnar format for statistics.
+
+File starts with `MAGIC` string and contains one or several series.
+Each series is a little-endian 32-bit header length, JSON header
+(padded with spaces to 8 bytes boundary) and two columns of
+little-endian 64-bit floats: all x values followed by all y values.
+Header gives repository name, its root, pipespec, range of
+revisions and number of points in series.
+
+Files are read with `read_binary` which memory-maps them. When numpy
+is available, columns are numpy arrays sharing memory with the map,
+so nothing is copied; otherwise columns are copied to `array.array`
+objects.
+
+Author and licensing
+====================
+
+Copyright (C) 2009 Dmitry Dzhus <dima@sphinx.net.ru>
+
+This code is subject to GNU GPL version 2 license, as can be read on
+http://www.gnu.org/licenses/gpl-2.0.html.
+"""
+
+import os
+import sys
+import mmap
+import json
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'HGSTATS1'
+
+_length = struct.Struct('<I')
+
+class BadBinaryFile(Exception):
+    pass
+
+def _le_column(values):
+    """
+    Return little-endian string of 64-bit floats from `values`.
+    """
+    column = array('d', values)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tostring()
+
+def write_series(stats_file, header, columns):
+    """
+    Write one series with `header` dictionary and
+    `processing.Columns` to `stats_file`.
+
+    ``count`` field is added to header.
+    """
+    header = dict(header, count=len(columns))
+    data = json.dumps(header, sort_keys=True)
+    # Keep columns aligned to 8 bytes
+    data += ' ' * (-(_length.size + len(data)) % 8)
+    stats_file.write(_length.pack(len(data)))
+    stats_file.write(data)
+    stats_file.write(_le_column(columns.x))
+    stats_file.write(_le_column(columns.y))
+
+def write_binary(file_name, series):
+    """
+    Write a list of (header, columns) pairs to file `file_name`.
+    """
+    stats_file = open(file_name, 'wb')
+    try:
+        stats_file.write(MAGIC)
+        for (header, columns) in series:
+            write_series(stats_file, header, columns)
+    finally:
+        stats_file.close()
+
+def _column(buf, offset, count):
+    if numpy:
+        return numpy.frombuffer(buf, numpy.dtype('<f8'), count, offset)
+    column = array('d')
+    column.fromstring(buf[offset:offset + 8 * count])
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+def read_binary(file_name):
+    """
+    Read file written by `write_binary`, return a list of (header, x,
+    y) tuples.
+    """
+    stats_file = open(file_name, 'rb')
+    try:
+        size = os.fstat(stats_file.fileno()).st_size
+        if size < len(MAGIC):
+            raise BadBinaryFile('%s is too short' % file_name)
+        buf = mmap.mmap(stats_file.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        stats_file.close()
+    if buf[:len(MAGIC)] != MAGIC:
+        raise BadBinaryFile('%s is not a hgstats binary file' % file_name)
+    series = []
+    offset = len(MAGIC)
+    while offset < size:
+        (length,) = _length.unpack_from(buf, offset)
+        offset += _length.size
+        header = json.loads(buf[offset:offset + length])
+        offset += length
+        count = header['count']
+        if offset + 16 * count > size:
+            raise BadBinaryFile('%s is truncated' % file_name)
+        x = _column(buf, offset, count)
+        y = _column(buf, offset + 8 * count, count)
+        offset += 16 * count
+        series.append((header, x, y))
+    return series
@@ -0,0 +1,425 @@
+"""
+Description
+===========
+
+Persistent caches for expensive per-changeset computations.
+
+Cache files are kept in ``.hg/cache`` directory of repository. If it
+is not writable, user cache directory (``$XDG_CACHE_HOME/hgstats`` or
+``~/.cache/hgstats``) is used instead.
+
+All cached data is keyed by changeset node. As node hash covers
+changeset contents and its parents, cached values never become wrong
+when history is rewritten (strip, rebase): rewritten changesets simply
+get new nodes. Entries for nodes which have disappeared from
+repository are dropped when cache is saved.
+
+Author and licensing
+====================
+
+Copyright (C) 2009 Dmitry Dzhus <dima@sphinx.net.ru>
+
+This code is subject to GNU GPL version 2 license, as can be read on
+http://www.gnu.org/licenses/gpl-2.0.html.
+"""
+
+import os
+import errno
+import hashlib
+import cPickle
+from array import array
+from bisect import bisect_left, bisect_right
+
+from mercurial.node import hex, bin
+
+from helpers import atomic_write
+
+# Bump when cache file format changes, old files will be ignored
+CACHE_VERSION = 1
+
+def user_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or \
+           os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'hgstats')
+
+def _ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            raise
+    return os.access(path, os.W_OK)
+
+def cache_path(repo, name):
+    """
+    Return path to cache file `name` for `repo`, creating cache
+    directory if needed.
+    """
+    try:
+        if _ensure_dir(os.path.join(repo.path, 'cache')):
+            return os.path.join(repo.path, 'cache', 'hgstats-%s' % name)
+    except OSError:
+        pass
+    _ensure_dir(user_cache_dir())
+    root_hash = hashlib.sha1(repo.root).hexdigest()[:12]
+    return os.path.join(user_cache_dir(), '%s-%s' % (root_hash, name))
+
+# Loaded diffstat caches, by class, repository root and constructor
+# arguments
+_diffstat_caches = {}
+
+class DiffstatCache():
+    """
+    Maps changeset nodes to ``(added, removed, files)`` tuples of
+    diffstat against first parent.
+    """
+    # Cache file name and first line
+    name = 'diffstat'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = cache_path(repo, self.name)
+        self.data = {}
+        self.dirty = False
+        self.load()
+
+    @classmethod
+    def shared(cls, repo, *args):
+        """
+        Return cache for `repo` (constructed with `args`), sharing it
+        with previous callers so that long-running processes read
+        cache file only once.
+        """
+        key = (cls, repo.root) + args
+        cache = _diffstat_caches.get(key)
+        if cache is None:
+            cache = _diffstat_caches[key] = cls(repo, *args)
+        else:
+            # Nodes don't change when repository is reopened
+            cache.repo = repo
+        return cache
+
+    def load(self):
+        """
+        Read cache file. Missing, outdated or broken files are
+        silently ignored.
+        """
+        try:
+            cache_file = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            lines = cache_file.read().splitlines()
+        finally:
+            cache_file.close()
+        if not lines or lines[0] != 'hgstats-%s %d' % (self.name, CACHE_VERSION):
+            return
+        try:
+            self.data = self.parse(lines[1:])
+        except (ValueError, TypeError):
+            return
+
+    def parse(self, lines):
+        """
+        Return cached data read from cache file `lines`.
+        """
+        data = {}
+        for line in lines:
+            node, added, removed, files = line.split(' ')
+            data[bin(node)] = (int(added), int(removed), int(files))
+        return data
+
+    def format(self, node, stats):
+        """
+        Return list of cache file lines for `stats` of `node`.
+        """
+        return ['%s %d %d %d' % ((hex(node),) + stats)]
+
+    def save(self):
+        """
+        Write cache file if anything was added since it was loaded.
+        """
+        if not self.dirty:
+            return
+        changelog = self.repo.changelog
+        lines = ['hgstats-%s %d' % (self.name, CACHE_VERSION)]
+        for node, stats in self.data.iteritems():
+            # Forget stripped changesets
+            if changelog.hasnode(node):
+                lines.extend(self.format(node, stats))
+        try:
+            atomic_write(self.path, '\n'.join(lines) + '\n')
+        except (IOError, OSError):
+            # Cache is an optimization only
+            return
+        self.dirty = False
+
+    def get(self, node):
+        """
+        Return cached stats for changeset `node` or None.
+        """
+        return self.data.get(node)
+
+    def set(self, node, stats):
+        self.data[node] = tuple(stats)
+        self.dirty = True
+
+class FileDiffstatCache(DiffstatCache):
+    """
+    Maps changeset nodes to tuples of ``(file, added, removed)``
+    tuples with diffstat of every file changed against first parent.
+
+    If only files matching `include` and not matching `exclude` glob
+    patterns were diffed, a separate cache is kept for these
+    patterns.
+    """
+    def __init__(self, repo, include=(), exclude=()):
+        self.name = 'filediffstat'
+        if include or exclude:
+            patterns = '\0'.join(include) + '\0\0' + '\0'.join(exclude)
+            self.name += '-' + hashlib.sha1(patterns).hexdigest()[:12]
+        DiffstatCache.__init__(self, repo)
+
+    def parse(self, lines):
+        # Node lines are followed by a line for every file
+        data, files = {}, None
+        for line in lines:
+            if line.startswith('\t'):
+                if files is None:
+                    raise ValueError('File line without node')
+                filename, added, removed = line[1:].rsplit('\t', 2)
+                files.append((filename, int(added), int(removed)))
+            else:
+                files = []
+                data[bin(line)] = files
+        for node in data:
+            data[node] = tuple(data[node])
+        return data
+
+    def format(self, node, stats):
+        return [hex(node)] + ['\t%s\t%d\t%d' % file_stats for file_stats in stats]
+
+# Loaded indexes, by repository root
+_indexes = {}
+
+class RepoIndex():
+    """
+    Changeset metadata of a repository, stored in arrays indexed by
+    revision number:
+
+    - ``date``: changeset date in Epoch seconds;
+    - ``tz``: timezone offset in seconds;
+    - ``p1``, ``p2``: parent revisions (-1 for null);
+    - ``author``, ``branch``: indexes in ``authors`` and ``branches``
+      lists;
+    - ``date_max``: greatest date of this and all previous changesets;
+    - ``date_min``: least date of this and all subsequent changesets.
+
+    Changeset dates may go backwards, but ``date_max`` and
+    ``date_min`` never do, so they may be bisected to find changesets
+    made in a period of time.
+
+    ``tags`` maps revisions to lists of their tags (``tip`` is not
+    included). Tags are read from repository every time index is
+    loaded, as they may change for old changesets.
+
+    Index is built with one sequential pass over changelog and saved
+    to cache file. Subsequent loads only read changesets added since
+    then, unless history has been rewritten.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = cache_path(repo, 'index')
+        self.clear()
+        self.load()
+        self.update()
+
+    @classmethod
+    def get(cls, repo):
+        """
+        Return up-to-date index for `repo`, sharing it with previous
+        callers.
+        """
+        index = _indexes.get(repo.root)
+        if index is None or not index.repo is repo:
+            index = _indexes[repo.root] = cls(repo)
+        else:
+            index.update()
+        return index
+
+    def clear(self):
+        self.date = array('d')
+        self.tz = array('l')
+        self.p1 = array('l')
+        self.p2 = array('l')
+        self.author = array('l')
+        self.branch = array('l')
+        self.date_max = array('d')
+        self.date_min = array('d')
+        self.authors = []
+        self.branches = []
+        self.tip_node = None
+
+    _fields = ['date', 'tz', 'p1', 'p2', 'author', 'branch', 'date_max',
+               'date_min', 'authors', 'branches', 'tip_node']
+
+    def __len__(self):
+        return len(self.date)
+
+    def _valid(self):
+        """
+        Check that indexed revisions are still there.
+        """
+        changelog = self.repo.changelog
+        count = len(self)
+        return count == 0 or \
+               (count <= len(changelog) and \
+                changelog.node(count - 1) == self.tip_node)
+
+    def load(self):
+        try:
+            index_file = open(self.path, 'rb')
+            try:
+                data = cPickle.load(index_file)
+            finally:
+                index_file.close()
+            if not data.get('version') == CACHE_VERSION:
+                return
+            for field in self._fields:
+                setattr(self, field, data[field])
+        except Exception:
+            self.clear()
+            return
+        if not self._valid():
+            self.clear()
+
+    def save(self):
+        data = {'version': CACHE_VERSION}
+        for field in self._fields:
+            data[field] = getattr(self, field)
+        try:
+            atomic_write(self.path, cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            pass
+
+    def update(self):
+        """
+        Index changesets added since index was built and reread tags.
+        """
+        changelog = self.repo.changelog
+        if not self._valid():
+            self.clear()
+        start = len(self)
+        if start < len(changelog):
+            author_ids = dict([(a, i) for (i, a) in enumerate(self.authors)])
+            branch_ids = dict([(b, i) for (i, b) in enumerate(self.branches)])
+            def intern(value, ids, values):
+                if not value in ids:
+                    ids[value] = len(values)
+                    values.append(value)
+                return ids[value]
+            for rev in xrange(start, len(changelog)):
+                manifest, user, date, files, desc, extra = \
+                          changelog.read(changelog.node(rev))
+                p1, p2 = changelog.parentrevs(rev)
+                self.date.append(date[0])
+                self.tz.append(date[1])
+                self.p1.append(p1)
+                self.p2.append(p2)
+                self.author.append(intern(user, author_ids, self.authors))
+                self.branch.append(intern(extra.get('branch', 'default'),
+                                          branch_ids, self.branches))
+            self._update_bounds(start)
+            self.tip_node = changelog.node(len(changelog) - 1)
+            self.save()
+        self.tags = {}
+        for (tag, node) in sorted(self.repo.tags().iteritems()):
+            if not tag == 'tip':
+                self.tags.setdefault(changelog.rev(node), []).append(tag)
+
+    def _update_bounds(self, start):
+        """
+        Extend ``date_max`` and ``date_min`` for revisions added
+        starting with `start`.
+        """
+        date, date_max, date_min = self.date, self.date_max, self.date_min
+        top = start and date_max[-1] or date[start]
+        for rev in xrange(start, len(date)):
+            top = max(top, date[rev])
+            date_max.append(top)
+        new_min = array('d', date[start:])
+        for rev in xrange(len(new_min) - 2, -1, -1):
+            new_min[rev] = min(new_min[rev], new_min[rev + 1])
+        # Only a few last revisions usually get smaller bound
+        bottom = new_min[0]
+        rev = start - 1
+        while rev >= 0 and date_min[rev] > bottom:
+            date_min[rev] = bottom
+            rev -= 1
+        date_min.extend(new_min)
+
+    def date_revs(self, start, end):
+        """
+        Return a tuple with the first and the last revision numbers of
+        range which holds all changesets with dates from `start` to
+        `end`. Changesets with other dates may be there too if dates
+        go backwards in history.
+        """
+        return (bisect_left(self.date_max, start),
+                bisect_right(self.date_min, end) - 1)
+
+    def node(self, rev):
+        return self.repo.changelog.node(rev)
+
+    def tagged_revs(self):
+        """
+        Return sorted list of tagged revisions.
+        """
+        return sorted(self.tags.keys())
+
+class ScanRecord():
+    """
+    Remembers changelog stamps (see `helpers.changelog_stamp`) of
+    repositories found under a directory, so that repositories which
+    have not changed since previous scan may be skipped.
+    """
+    def __init__(self, root):
+        _ensure_dir(user_cache_dir())
+        root_hash = hashlib.sha1(os.path.abspath(root)).hexdigest()[:12]
+        self.path = os.path.join(user_cache_dir(), 'scan-%s' % root_hash)
+        self.stamps = {}
+        self.dirty = False
+        try:
+            record_file = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            for line in record_file.read().splitlines():
+                mtime, size, path = line.split(' ', 2)
+                self.stamps[path] = (float(mtime), int(size))
+        except ValueError:
+            self.stamps = {}
+        record_file.close()
+
+    def changed(self, path, stamp):
+        """
+        Return True if repository at `path` has `stamp` different from
+        the recorded one.
+        """
+        return not self.stamps.get(path) == stamp
+
+    def update(self, path, stamp):
+        self.stamps[path] = stamp
+        self.dirty = True
+
+    def forget(self, path):
+        if self.stamps.pop(path, None):
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        lines = ['%r %d %s' % (stamp[0], stamp[1], path)
+                 for (path, stamp) in sorted(self.stamps.iteritems())]
+        atomic_write(self.path, '\n'.join(lines) + '\n')
+        self.dirty = False
@@ -21,14 +21,34 @@ import datetime
 from pygooglechart import XYLineChart, Axis
 
 from helpers import get_repo_name
+from processing import lttb
 
 # Tango colors
 CHART_COLORS = ['A40000', '204A87', '4E9A06', 'CE5C00', '5C3566', 'C4A000',\
                 'CC0000', '3465A4', '73D216', 'F57900']
 
 def _gchart_add_stats(chart, stats):
-    chart.add_data(map(lambda i: i.x, stats))
-    chart.add_data(map(lambda i: i.y, stats))
+    # Walk stats only once
+    x, y = [], []
+    for item in stats:
+        for (item_x, item_y) in item.points():
+            x.append(item_x)
+            y.append(item_y)
+    # There's no use in more points than pixels, while long URLs are
+    # refused
+    kept = lttb(x, y, chart.width)
+    if len(kept) < len(x):
+        x = [x[i] for i in kept]
+        y = [y[i] for i in kept]
+    chart.add_data(x)
+    chart.add_data(y)
+
+def _legend(res):
+    repo, stream = res
+    label = getattr(stream, 'meta', {}).get('series')
+    if label:
+        return '%s: %s' % (get_repo_name(repo), label)
+    return get_repo_name(repo)
 
 def _make_chart(width=600, height=200, **chart_kwargs):
     chart = XYLineChart(width, height, **chart_kwargs)
@@ -74,7 +94,7 @@ def gchart_stats(res_list, **chart_kwargs):
     chart = _make_chart(**chart_kwargs)
     for res in res_list:
         _gchart_add_stats(chart, res[1])
-    chart.set_legend(map(lambda res: get_repo_name(res[0]), res_list))
+    chart.set_legend(map(_legend, res_list))
     # If X values are timestamps, format them
     chart.set_axis_labels(Axis.BOTTOM,
                           make_labels(chart.data_x_range(),
@@ -15,7 +15,138 @@ This code is subject to GNU GPL version 2 license, as can be read on
 http://www.gnu.org/licenses/gpl-2.0.html.
 """
 
+import os
+import stat
+import errno
+import binascii
 from os.path import basename
 
+# os.scandir is available since Python 3.5, scandir module provides
+# it for older versions
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 def get_repo_name(repo):
     return basename(repo.root)
+
+class RepoStub():
+    """
+    Stands for repository in results when only its root is known,
+    e.g. for results computed in another process.
+    """
+    def __init__(self, root):
+        self.root = root
+
+class AtomicFile():
+    """
+    File which appears under `file_name` only when closed, so that
+    readers never see it partially written.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        while True:
+            self.tmp_name = os.path.join(os.path.dirname(file_name),
+                                         '.%s-%s' % (basename(file_name),
+                                                     binascii.hexlify(os.urandom(6))))
+            # Unlike mkstemp, leave permissions of new files to umask
+            try:
+                fd = os.open(self.tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            except OSError, err:
+                if err.errno == errno.EEXIST:
+                    continue
+                raise
+            break
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        """
+        Put written file in place, keeping permissions of the file it
+        replaces, if any.
+        """
+        try:
+            self.file.close()
+            try:
+                mode = stat.S_IMODE(os.stat(self.file_name).st_mode)
+            except OSError:
+                mode = None
+            if mode is not None:
+                os.chmod(self.tmp_name, mode)
+            os.rename(self.tmp_name, self.file_name)
+        except:
+            self.discard()
+            raise
+
+    def discard(self):
+        """
+        Throw away everything written.
+        """
+        self.file.close()
+        if os.path.exists(self.tmp_name):
+            os.unlink(self.tmp_name)
+
+def atomic_write(file_name, data):
+    """
+    Write `data` string to `file_name` so that readers never see a
+    partially written file.
+    """
+    atomic_file = AtomicFile(file_name)
+    try:
+        atomic_file.write(data)
+    except:
+        atomic_file.discard()
+        raise
+    atomic_file.close()
+
+def _subdirs(path):
+    """
+    Return sorted list of names of subdirectories of `path`, not
+    following symbolic links.
+    """
+    try:
+        if scandir:
+            names = [e.name for e in scandir(path)
+                     if e.is_dir(follow_symlinks=False)]
+        else:
+            names = [n for n in os.listdir(path)
+                     if os.path.isdir(os.path.join(path, n)) and
+                     not os.path.islink(os.path.join(path, n))]
+    except OSError:
+        return []
+    return sorted(names)
+
+def find_repos(root):
+    """
+    Yield paths to all Mercurial repositories under `root` directory
+    as soon as they are found.
+
+    Directories of found repositories are not descended into.
+    """
+    subdirs = _subdirs(root)
+    if '.hg' in subdirs:
+        yield root
+        return
+    for name in subdirs:
+        for path in find_repos(os.path.join(root, name)):
+            yield path
+
+def changelog_stamp(path):
+    """
+    Return a tuple with modification time and size of changelog of
+    repository at `path` or None if it's not available.
+    """
+    for changelog in [os.path.join(path, '.hg', 'store', '00changelog.i'),
+                      os.path.join(path, '.hg', '00changelog.i')]:
+        try:
+            st = os.stat(changelog)
+        except OSError:
+            continue
+        return (st.st_mtime, st.st_size)
+    return None
@@ -16,19 +16,29 @@ be read on <http://www.gnu.org/licenses/gpl-2.0.html>.
 
 import os
 import sys
+import time
+import json
 import datetime
 import getopt
+import multiprocessing
+from itertools import chain, imap
+from collections import deque
 
 from mercurial import hg, ui
 from mercurial.error import RepoError
 from mercurial.i18n import _
 from mercurial.fancyopts import fancyopts
 
-from helpers import get_repo_name
-from pipespec import parse_pipespec
+from helpers import get_repo_name, RepoStub, find_repos, changelog_stamp
+from cache import ScanRecord, RepoIndex
+from pipespec import parse_pipespec, PlanSet
+from incremental import incremental_stream
+from instrument import count_iterations, format_counts, max_rss
+from instrument import profile_stages, profile_rows, rev_times, format_profile
+from processing import ColumnStream, BadAliases, read_aliases
 
-from output import STATS_BASENAME
-from output import PrintOutput, FileOutput, GchartOutput
+from output import STATS_BASENAME, check_compression, aggregate_results
+from output import PrintOutput, FileOutput, BinaryOutput, GchartOutput
 
 def process_repo(repo, filters, method, combine):
     """
@@ -45,6 +55,15 @@ def process_repo(repo, filters, method, combine):
     else:
         raise UnknownOutputMethod
 
+def get_ui():
+    """
+    Return `mercurial.ui.ui` instance shared by all repositories.
+    """
+    global repo_ui
+    if not repo_ui:
+        repo_ui = ui.ui()
+    return repo_ui
+
 def try_repo_path(path):
     """
     Return repository at `path` or print log message if it's not
@@ -55,7 +74,7 @@ def try_repo_path(path):
         Return repository at `repo_path` or False if it doesn't exist.
         """
         try:
-            repo = hg.repository(ui.ui(), path)
+            repo = hg.repository(get_ui(), path)
         except RepoError, err:
             repo = False
         return repo
@@ -69,6 +88,197 @@ def try_repo_path(path):
     else:
         return repo
 
+def good_repos(path_list):
+    """
+    Yield tuples with paths from `path_list` and repositories at them,
+    reporting paths without valid local repository (see
+    `report_failure`).
+    """
+    for path in path_list:
+        repo = try_repo_path(path)
+        if repo:
+            yield path, repo
+        else:
+            report_failure(path, 'No valid repository at %s' % path)
+
+def report_failure(path, message):
+    """
+    Print `message` about repository at `path` which could not be
+    processed and remember it, so that the run fails in the end.
+    """
+    print >> sys.stderr, message
+    failed_paths.append(path)
+
+def evaluated_results(path_list):
+    """
+    Yield tuples with repository, stream and profile for results of
+    all pipespecs (see `evaluate`) for repositories at paths from
+    `path_list`, evaluating one repository at a time.
+    """
+    for (path, repo) in good_repos(path_list):
+        results = evaluate(repo)
+        record_scanned(path)
+        for s in results:
+            yield repo, s, getattr(s, 'profile', None)
+
+def evaluate(repo):
+    """
+    Return a list of `processing.ColumnStream` objects with results
+    of all pipespecs for `repo`.
+
+    Pipelines are evaluated right away and exactly once, all
+    consumers of the returned streams share the results. Stages
+    common to several pipespecs are evaluated once as well (see
+    `pipespec.PlanSet`), except in incremental mode, where every
+    pipespec is continued from its own saved state.
+    """
+    global evaluation_wall
+    wall = time.time()
+    if options['incremental']:
+        res = [incremental_stream(repo, plan.pipespec, plans.builder(n))
+               for (n, plan) in enumerate(plans)]
+    elif profiling():
+        seen = set()
+        profiled = [profile_stages(s, bool(options['profile_revs']), seen)
+                    for s in plans(repo)]
+        res = []
+        for (plan, (s, profiles)) in zip(plans, profiled):
+            s = ColumnStream(s)
+            s.columns()
+            s.profile = {'repo': get_repo_name(repo), 'pipespec': plan.pipespec,
+                         'profiles': profiles}
+            res.append(s)
+        # Shared stages are measured when all pipespecs are done
+        for s in res:
+            profiles = s.profile.pop('profiles')
+            s.profile['stages'] = profile_rows(profiles)
+            s.profile['revs'] = rev_times(profiles)
+    else:
+        counts, seen = {}, set()
+        res = [ColumnStream(count_iterations(s, counts, seen)[0])
+               for s in plans(repo)]
+        for s in res:
+            s.columns()
+        dprint('Stage iterations: %s' % format_counts(counts))
+    evaluation_wall += time.time() - wall
+    return res
+
+def evaluate_path(path):
+    """
+    Evaluate pipespec for repository at `path`.
+
+    Return a tuple with `path` and either a tuple with repository
+    root and a list of results for all pipespecs, or None if there's
+    no valid repository at `path`. Every result is a tuple with
+    stream name, its `processing.Columns`, ``meta`` dictionary and
+    profile (see `evaluate`). Errors are raised.
+    """
+    repo = try_repo_path(path)
+    if not repo:
+        return path, None
+    return path, (repo.root, [(str(s), s.columns(), s.meta,
+                               getattr(s, 'profile', None))
+                              for s in evaluate(repo)])
+
+def concurrent_results(path_list, jobs):
+    """
+    Evaluate pipespec for repositories at paths from `path_list` in
+    `jobs` worker processes, yielding results for output in the order
+    of `path_list`.
+
+    At most 2*`jobs` repositories are processed or waiting to be
+    output at any time. Repositories which fail to process are
+    reported (see `report_failure`) and skipped.
+    """
+    def result(pending_res):
+        path, async_res = pending_res
+        try:
+            path, res = async_res.get()
+        except Exception, err:
+            report_failure(path, 'Failed to process %s: %s' % (path, err))
+            return None
+        if res is None:
+            report_failure(path, 'No valid repository at %s' % path)
+        else:
+            record_scanned(path)
+        return res
+
+    pool = multiprocessing.Pool(jobs)
+    pending = deque()
+    try:
+        for path in path_list:
+            pending.append((path, pool.apply_async(evaluate_path, (path,))))
+            while len(pending) >= 2 * jobs:
+                res = result(pending.popleft())
+                if res:
+                    yield res
+        while pending:
+            res = result(pending.popleft())
+            if res:
+                yield res
+    finally:
+        pool.terminate()
+
+def scan_paths(root):
+    """
+    Yield paths to repositories found under `root` directory.
+
+    If `scan_record` is set, repositories with changelog unchanged
+    since previous scan are skipped. Changelog stamps of yielded
+    repositories are recorded by `record_scanned` once they are
+    processed.
+    """
+    for path in find_repos(root):
+        if scan_record:
+            stamp = changelog_stamp(path)
+            if not scan_record.changed(path, stamp):
+                dprint('Repository %s has not changed, skipped' % path)
+                continue
+            scan_stamps[path] = stamp
+        yield path
+
+def record_scanned(path):
+    """
+    Record changelog stamp of scanned repository at `path` after it
+    has been processed successfully (see `scan_paths`).
+    """
+    stamp = scan_stamps.pop(path, None)
+    if scan_record and stamp:
+        scan_record.update(path, stamp)
+
+def profiling():
+    return options['profile'] or options['profile_json'] or options['profile_revs']
+
+def report_profile(profiles, wall, cpu):
+    """
+    Print measurements for all repositories from `profiles` list and
+    total `wall` and `cpu` time of the run, write them to files if
+    requested.
+    """
+    for profile in profiles:
+        print >> sys.stderr, 'Profile for %s (%s):' % \
+              (profile['repo'], profile['pipespec'] or 'RepoStream')
+        print >> sys.stderr, format_profile(profile['stages'])
+    print >> sys.stderr, 'Total: %.3f s wall, %.3f s cpu, %.1f MiB peak rss' % \
+          (wall, cpu, max_rss() / 1024.0)
+    report = {'repos': [dict(p, revs=None) for p in profiles],
+              'wall': wall, 'cpu': cpu, 'max_rss': max_rss()}
+    # Pipelines are evaluated in this process while output is written
+    # only when repositories are processed one by one
+    if options['repo_jobs'] <= 1:
+        report['output_wall'] = wall - evaluation_wall
+        print >> sys.stderr, 'Output and other: %.3f s wall' % report['output_wall']
+    if options['profile_json']:
+        profile_file = open(options['profile_json'], 'w')
+        json.dump(report, profile_file, indent=1)
+        profile_file.close()
+    if options['profile_revs']:
+        revs_file = open(options['profile_revs'], 'w')
+        for profile in profiles:
+            for (stage, rev, seconds) in profile['revs']:
+                revs_file.write('%s %d %.6f\n' % (stage, rev, seconds))
+        revs_file.close()
+
 def dprint(msg):
     if options['verbose']:
         print >> sys.stderr, msg
@@ -78,16 +288,45 @@ def print_usage():
 
 options = {}
 
+repo_ui = None
+
+scan_record = None
+
+# Changelog stamps of scanned repositories not processed yet, by path
+scan_stamps = {}
+
+# Paths of repositories which could not be processed
+failed_paths = []
+
+# Time spent to evaluate pipespecs in this process
+evaluation_wall = 0.0
+
 optable = [
-    ('p', 'pipespec', '', _('Dash-separated list of filter names to be applied to repo')),
-    ('o', 'output', 'print', _('Output method (print/file/gchart)')),
+    ('p', 'pipespec', [], _('Dash-separated list of filter names to be applied to repo (may be given several times)')),
+    ('o', 'output', 'print', _('Output method (print/file/binary/gchart)')),
+    ('z', 'compress', '', _('Compress files written by file output (gzip/zstd)')),
     ('c', 'combine', False, _('Combine results for all repositories in one file or gchart')),
+    ('a', 'aggregate', '', _('Merge results of all repositories into one series, summing (sum) or accumulating (acc) values')),
+    ('I', 'include', [], _('Only diff files matching this glob in path filters (may be given several times)')),
+    ('X', 'exclude', [], _('Do not diff files matching this glob in path filters (may be given several times)')),
+    ('', 'join-repo', '', _('Evaluate pipespecs joined by DropFilter over this repository')),
+    ('', 'aliases', '', _('Author aliases file for AuthorFilter (.hgchurn in repository root by default)')),
+    ('j', 'jobs', 1, _('Number of worker processes used by DiffstatFilter')),
+    ('', 'repo-jobs', 1, _('Number of repositories processed concurrently')),
+    ('i', 'incremental', False, _('Only process revisions added since previous run')),
+    ('s', 'scan', '', _('Process all repositories found under this directory')),
+    ('u', 'skip-unchanged', False, _('Skip scanned repositories not changed since previous scan')),
+    ('', 'explain', False, _('Show what pipespec will run and exit')),
+    ('', 'profile', False, _('Report time and memory spent by every stage (not with --incremental)')),
+    ('', 'profile-json', '', _('Write profile to this file as JSON')),
+    ('', 'profile-revs', '', _('Write time spent by stages on every changeset to this file')),
     ('v', 'verbose', False, _('More debugging output'))
     ]
 
 output_table = {
     'print': PrintOutput,
     'file': FileOutput,
+    'binary': BinaryOutput,
     'gchart': GchartOutput
     }
 
@@ -97,12 +336,95 @@ if __name__ == '__main__':
     except getopt.GetoptError:
         print_usage()
         exit()
-    filters = parse_pipespec(options['pipespec'])
+    target_repo = None
+    if options['join_repo']:
+        target_repo = try_repo_path(options['join_repo'])
+        if not target_repo:
+            print >> sys.stderr, 'No valid repository at %s' % options['join_repo']
+            exit(1)
+    if options['aliases']:
+        # Check aliases file before processing anything
+        try:
+            read_aliases(options['aliases'])
+        except (IOError, BadAliases), err:
+            print >> sys.stderr, err
+            exit(1)
+    settings = {'workers': options['jobs'],
+                'aliases': options['aliases'] or None,
+                'include': options['include'],
+                'exclude': options['exclude']}
+    if options['repo_jobs'] > 1:
+        # Worker processes may not start their own pools
+        settings['workers'] = 1
+    plans = PlanSet([parse_pipespec(pipespec, settings)
+                     for pipespec in options['pipespec'] or ['']], target_repo)
+    output = output_table[options['output']]
+    compress = options['compress'] or None
+    check_compression(compress)
+    if not options['aggregate'] in ('', 'sum', 'acc'):
+        print_usage()
+        exit()
 
-    # Process only good repositories
-    repo_list = filter(None, map(try_repo_path, path_list))
-    if repo_list:
-        output = output_table[options['output']]
-        dprint(output(map(lambda r:(r, filters(r)), repo_list), options['combine'])())
-    else:
+    if options['explain']:
+        repos = filter(None, map(try_repo_path, path_list))
+        for plan in plans:
+            if len(plans) > 1:
+                print 'Pipespec %s:' % plan.pipespec
+            if not repos:
+                print plan
+            for repo in repos:
+                print 'Plan for %s (%d revisions):' % (repo.root, len(repo))
+                print plan.explain(RepoIndex.get(repo))
+        exit()
+
+    if options['scan']:
+        if options['skip_unchanged']:
+            scan_record = ScanRecord(options['scan'])
+        path_list = chain(path_list, scan_paths(options['scan']))
+    elif not path_list:
         print_usage()
+        exit()
+
+    profiles = []
+    merged_paths = []
+    def collect(res):
+        repo, s, profile = res
+        if profile:
+            profiles.append(profile)
+        return repo, s
+
+    if options['repo_jobs'] > 1:
+        res = ((RepoStub(root), ColumnStream.from_columns(name, cols, meta), profile)
+               for (root, results) in
+               concurrent_results(path_list, options['repo_jobs'])
+               for (name, cols, meta, profile) in results)
+    elif options['aggregate'] and not (options['incremental'] or profiling()):
+        # Pipelines of all repositories are merged as they are
+        # evaluated, one item at a time, so they are processed only
+        # when output is done
+        def merged_streams():
+            for (path, repo) in good_repos(path_list):
+                merged_paths.append(path)
+                for s in plans(repo):
+                    yield repo, s, None
+        res = merged_streams()
+    else:
+        # Process only good repositories
+        res = evaluated_results(path_list)
+    wall, cpu = time.time(), time.clock()
+    res = imap(collect, res)
+    if options['aggregate']:
+        res = aggregate_results(res, options['aggregate'] == 'acc')
+    if output is FileOutput:
+        output = output(res, options['combine'], compress)
+    else:
+        output = output(res, options['combine'])
+    dprint(output())
+    for path in merged_paths:
+        record_scanned(path)
+    if profiling():
+        report_profile(profiles, time.time() - wall, time.clock() - cpu)
+    if scan_record:
+        scan_record.save()
+    if failed_paths:
+        exit(1)
@@ -0,0 +1,126 @@
+"""
+Description
+===========
+
+Incremental statistics: pipeline results and final filter states are
+saved after every run, so that next run for the same pipespec only
+processes revisions added since then.
+
+Saved results are used only if the last processed revision is still
+present in repository under the same number, which is not the case
+after history has been rewritten (strip, rebase). Otherwise, or if
+some filter reports its state as stale, all revisions are processed
+again. The same happens on every run for pipespecs with filters which
+may not be resumed at all (like `processing.DownsampleFilter`).
+
+Author and licensing
+====================
+
+Copyright (C) 2009 Dmitry Dzhus <dima@sphinx.net.ru>
+
+This code is subject to GNU GPL version 2 license, as can be read on
+http://www.gnu.org/licenses/gpl-2.0.html.
+"""
+
+import hashlib
+import cPickle
+
+from cache import cache_path
+from helpers import atomic_write
+from processing import ColumnStream, Columns, StaleState, GroupingFilter
+from processing import stream_stages
+
+# Bump when saved state format changes, old files will be ignored
+STATE_VERSION = 1
+
+def _state_path(repo, pipespec):
+    return cache_path(repo, 'state-%s' % hashlib.sha1(pipespec).hexdigest()[:12])
+
+def load_state(repo, pipespec):
+    """
+    Return saved state for `pipespec` on `repo` if it may be continued
+    from, or None.
+    """
+    try:
+        state_file = open(_state_path(repo, pipespec), 'rb')
+        try:
+            state = cPickle.load(state_file)
+        finally:
+            state_file.close()
+    except Exception:
+        return None
+    if not isinstance(state, dict) or \
+       not state.get('version') == STATE_VERSION or \
+       not state.get('pipespec') == pipespec:
+        return None
+    rev = state['rev']
+    if rev >= len(repo) or not repo.changelog.node(rev) == state['node']:
+        return None
+    return state
+
+def save_state(repo, pipespec, rev, states, columns):
+    state = {'version': STATE_VERSION,
+             'pipespec': pipespec,
+             'rev': rev,
+             'node': repo.changelog.node(rev),
+             'states': states,
+             'columns': columns}
+    try:
+        atomic_write(_state_path(repo, pipespec),
+                     cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError):
+        pass
+
+def _restore(stream, states):
+    """
+    Apply `states` to all stages of `stream`, return `stream`.
+    """
+    for stage, state in zip(stream_stages(stream)[1:], states):
+        stage.set_state(state)
+    return stream
+
+def _build(repo, filters, from_rev, states, open_end):
+    stream = filters(repo, from_rev=from_rev)
+    for stage in stream_stages(stream):
+        if isinstance(stage, GroupingFilter):
+            stage.open_end = open_end
+    if states:
+        _restore(stream, states)
+    return stream
+
+def incremental_stream(repo, pipespec, filters):
+    """
+    Return `ColumnStream` with results of `filters` (as returned by
+    `pipespec.parse_pipespec(pipespec)`) applied to `repo`, computing
+    only revisions added since the previous call.
+    """
+    tip = len(repo) - 1
+    meta = {'pipespec': pipespec, 'from_rev': 0, 'to_rev': tip}
+    stream = filters(repo)
+    if not all(stage.resumable for stage in stream_stages(stream)[1:]):
+        return ColumnStream.from_columns(str(stream), stream.columns(), meta)
+
+    saved = load_state(repo, pipespec)
+    try:
+        if saved:
+            from_rev, states, done = saved['rev'] + 1, saved['states'], saved['columns']
+            # Check states early to fall back if they are stale
+            _restore(filters(repo, from_rev=from_rev), states)
+        else:
+            raise StaleState
+    except StaleState:
+        from_rev, states, done = 0, None, Columns()
+
+    # Final part of results, which will not be changed by new
+    # revisions
+    stream = _build(repo, filters, from_rev, states, True)
+    if from_rev <= tip:
+        done = done.concat(stream.columns())
+        states = [stage.get_state() for stage in stream_stages(stream)[1:]]
+        save_state(repo, pipespec, tip, states, done)
+
+    # Items which depend on current date (like trailing frames of
+    # GroupingFilter) are computed without any new input
+    tail = _build(repo, filters, tip + 1, states, False)
+    return ColumnStream.from_columns(str(stream), done.concat(tail.columns()),
+                                     meta)
@@ -0,0 +1,295 @@
+"""
+Description
+===========
+
+Instrumentation of filter chains.
+
+`count_iterations` inserts counting proxies between all stages of a
+filter chain, so that repeated evaluation of any stage may be noticed:
+
+>>> from mercurial import hg, ui
+>>> from processing import RepoStream, DiffstatFilter, AccFilter, ColumnStream
+>>> repo = hg.repository(ui.ui(), '/home/sphinx/projects/hgstats')
+>>> s, counts = count_iterations(AccFilter(DiffstatFilter(RepoStream(repo))))
+>>> s = ColumnStream(s)
+>>> for item in s:
+...     pass
+>>> print str(s)
+hgstats-DiffstatFilter-AccFilter
+>>> for item in s:
+...     pass
+>>> sorted(counts.items())
+[('hgstats', 1), ('hgstats-DiffstatFilter', 1), ('hgstats-DiffstatFilter-AccFilter', 1)]
+
+`profile_stages` inserts `ProfilingStream` proxies instead, which
+measure items produced, time and memory spent by every stage:
+
+>>> s, profiles = profile_stages(AccFilter(DiffstatFilter(RepoStream(repo))))
+>>> s = ColumnStream(s)
+>>> count = len(s.columns())
+>>> rows = profile_rows(profiles)
+>>> [(row['stage'], row['calls']) for row in rows]
+[('hgstats', 1), ('hgstats-DiffstatFilter', 1), ('hgstats-DiffstatFilter-AccFilter', 1)]
+>>> rows[-1]['items_in'] == rows[-1]['items_out'] == count
+True
+
+Author and licensing
+====================
+
+Copyright (C) 2009 Dmitry Dzhus <dima@sphinx.net.ru>
+
+This code is subject to GNU GPL version 2 license, as can be read on
+http://www.gnu.org/licenses/gpl-2.0.html.
+"""
+
+import time
+import resource
+
+from processing import StatStream, StreamProxy, SharedStream, Columns
+from processing import stream_stages
+
+class CountingStream(StreamProxy):
+    """
+    Counts how many times wrapped stream was iterated over or
+    evaluated column-wise.
+    """
+    def __init__(self, stream, counts):
+        """
+        Counts are stored in `counts` dictionary under string
+        representation of wrapped stream.
+        """
+        StreamProxy.__init__(self, stream)
+        self.counts = counts
+        self.name = str(stream)
+        counts.setdefault(self.name, 0)
+
+    def __iter__(self):
+        self.counts[self.name] += 1
+        return iter(self.stream)
+
+    def columns(self):
+        self.counts[self.name] += 1
+        return self.stream.columns()
+
+def _wrap_stages(stream, wrap, seen):
+    """
+    Replace all streams in filter chain which ends with `stream` with
+    results of `wrap` called on them, return wrapped `stream`.
+
+    Streams shared by several consumers (see `processing.SharedStream`)
+    are wrapped inside of their shared proxies, so that actual
+    evaluation is watched. Streams from ids in `seen` set are already
+    wrapped (they are common with chains wrapped before).
+    """
+    def wrap_input(owner):
+        if not id(owner) in seen:
+            seen.add(id(owner))
+            owner.stream = wrap(owner.stream)
+    for stage in stream_stages(stream)[1:]:
+        if isinstance(stage.stream, SharedStream):
+            wrap_input(stage.stream)
+        else:
+            wrap_input(stage)
+    if isinstance(stream, SharedStream):
+        wrap_input(stream)
+        return stream
+    return wrap(stream)
+
+def count_iterations(stream, counts=None, seen=None):
+    """
+    Wrap all stages of filter chain which ends with `stream` in
+    `CountingStream` proxies.
+
+    Return a tuple with wrapped `stream` and dictionary of counts.
+
+    When several chains with common stages are wrapped, the same
+    `counts` dictionary and `seen` set (see `_wrap_stages`) must be
+    passed for all of them.
+    """
+    if counts is None:
+        counts = {}
+    if seen is None:
+        seen = set()
+    return _wrap_stages(stream, lambda s: CountingStream(s, counts), seen), counts
+
+def format_counts(counts):
+    return ', '.join(['%s: %d' % c for c in sorted(counts.items())])
+
+def max_rss():
+    """
+    Return peak resident set size of current process in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class StageProfile():
+    """
+    Measurements for a single stage of filter chain, made by
+    `ProfilingStream`. Times exclude time spent in previous stages.
+    """
+    def __init__(self, name, by_items=False):
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self.wall = self.cpu = 0.0
+        self.max_rss = 0
+        # Time spent to produce items of changesets, by revision
+        self.revs = None
+        if by_items:
+            self.revs = {}
+
+    def add(self, wall, cpu):
+        self.wall += wall
+        self.cpu += cpu
+        self.max_rss = max_rss()
+
+# Wall and cpu time spent in nested measurements, for every
+# measurement in progress
+_nested = []
+
+def _measure(profile, call):
+    """
+    Return result of `call`, adding time spent by it to `profile`.
+
+    Time of measurements nested in `call` is not added, so that stages
+    reading results of a shared stage (see `processing.SharedStream`)
+    are not charged for it, no matter which of them evaluated it.
+    """
+    wall, cpu = time.time(), time.clock()
+    _nested.append([0.0, 0.0])
+    try:
+        return call()
+    finally:
+        nested = _nested.pop()
+        wall, cpu = time.time() - wall, time.clock() - cpu
+        if _nested:
+            _nested[-1][0] += wall
+            _nested[-1][1] += cpu
+        profile.add(wall - nested[0], cpu - nested[1])
+
+class ProfilingStream(StreamProxy):
+    """
+    Measures time spent to iterate over wrapped stream or evaluate it
+    column-wise, and number of items it produced.
+    """
+    def __init__(self, stream, profile, by_items=False):
+        """
+        Measurements are stored in `profile`, a `StageProfile`
+        instance.
+
+        If `by_items` is True, column-wise evaluation is done by
+        iterating over stream, so that time per changeset is measured.
+        """
+        StreamProxy.__init__(self, stream)
+        self.profile = profile
+        self.by_items = by_items
+
+    def __iter__(self):
+        profile = self.profile
+        revs = profile.revs
+        profile.calls += 1
+        items = iter(self.stream)
+        while True:
+            wall = profile.wall
+            try:
+                item = _measure(profile, items.next)
+            except StopIteration:
+                return
+            profile.items += 1
+            if revs is not None and hasattr(item, 'rev'):
+                revs[item.rev] = revs.get(item.rev, 0) + profile.wall - wall
+            yield item
+
+    def columns(self):
+        if self.by_items:
+            return Columns.from_items(self)
+        self.profile.calls += 1
+        cols = _measure(self.profile, self.stream.columns)
+        self.profile.items += len(cols)
+        return cols
+
+def profile_stages(stream, by_items=False, seen=None):
+    """
+    Wrap all stages of filter chain which ends with `stream` in
+    `ProfilingStream` proxies.
+
+    Return a tuple with wrapped `stream` and a list of `StageProfile`
+    objects for all stages, starting with the source one.
+
+    When several chains with common stages are wrapped, the same
+    `seen` set (see `_wrap_stages`) must be passed for all of them.
+    """
+    if seen is None:
+        seen = set()
+    def wrap(stream):
+        return ProfilingStream(stream, StageProfile(str(stream), by_items), by_items)
+    stream = _wrap_stages(stream, wrap, seen)
+    profiles = []
+    link = stream
+    while isinstance(link, StatStream):
+        if isinstance(link, ProfilingStream):
+            profiles.insert(0, link.profile)
+        link = link.stream
+    return stream, profiles
+
+def profile_rows(profiles):
+    """
+    Return a list of dictionaries with measurements for every stage
+    from `profiles` made by `profile_stages`.
+
+    Stages fused with next ones (see `processing.FusedStream`) are
+    not measured separately, and their time is included in the time
+    of the last stage of fused group. The same goes for `RepoStream`
+    read directly by the next filter (see
+    `processing.StreamFilter.reads_source`).
+    """
+    rows = []
+    prev = None
+    for profile in profiles:
+        row = {'stage': profile.name,
+               'calls': profile.calls,
+               'items_in': prev and prev.items or 0,
+               'items_out': profile.items,
+               'wall': profile.wall,
+               'cpu': profile.cpu,
+               'max_rss': profile.max_rss}
+        if profile.calls:
+            prev = profile
+        rows.append(row)
+    return rows
+
+def rev_times(profiles):
+    """
+    Return a list of ``(stage, rev, seconds)`` tuples with time spent
+    by stages on every changeset, slowest first. Changesets are
+    measured only if `profile_stages` was called with `by_items` set.
+    """
+    res = []
+    for profile in profiles:
+        if profile.calls and profile.revs:
+            for rev, seconds in profile.revs.iteritems():
+                res.append((profile.name, rev, seconds))
+    res.sort(key=lambda r: -r[2])
+    return res
+
+def format_profile(rows):
+    """
+    Return a table with measurements from `profile_rows` results.
+    """
+    width = max([len(row['stage']) for row in rows] + [5])
+    lines = ['%-*s %6s %10s %10s %10s %10s %10s' % \
+             (width, 'stage', 'calls', 'items in', 'items out',
+              'wall, s', 'cpu, s', 'rss, MiB')]
+    for row in rows:
+        if not row['calls']:
+            lines.append('%-*s %6s %10s %10s %10s %10s %10s' % \
+                         (width, row['stage'], 0, '', '', 'n/a', '', ''))
+            continue
+        lines.append('%-*s %6d %10d %10d %10.3f %10.3f %10.1f' % \
+                     (width, row['stage'], row['calls'], row['items_in'],
+                      row['items_out'], row['wall'], row['cpu'],
+                      row['max_rss'] / 1024.0))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -13,28 +13,217 @@ This code is subject to GNU GPL version 2 license, as can be read on
 http://www.gnu.org/licenses/gpl-2.0.html.
 """
 
-import os
+import re
+import sys
+import gzip
+from itertools import imap, izip
 
-from helpers import get_repo_name
+# zstd compression is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from helpers import get_repo_name, RepoStub, AtomicFile
+from processing import ColumnStream, MergeStream, SeriesStream, stream_stages
 from gchart import gchart_url_stats
+from binfile import write_binary
 
 # Default file name for combined stats
 STATS_BASENAME = 'hgstats'
 
+# Number of stats lines formatted and written at once
+BATCH_SIZE = 4096
+
+# Characters replaced in file names
+_unsafe = re.compile(r'[^\w.@+-]+')
+
 ## Exceptions
 
 class UnknownOutputMethod(Exception):
     pass
 
+class UnknownCompression(Exception):
+    pass
+
 ## Helpers
 
 def make_stats_line(item):
-    """Prepare writable line from `StatsItem` instance."""
+    """
+    Prepare writable line from `StatsItem` instance.
+
+    Spans of items (`processing.SpanStatItem`) take two lines, one
+    for each end.
+    """
     return str(item)
 
 def header_line(repo, stream):
     return "# Stats for %s from %s" % (get_repo_name(repo), stream)
 
+def stats_blocks(repo, stream):
+    """
+    Yield text for `stream` statistics of `repo` in large blocks:
+    header line first, then `BATCH_SIZE` lines of stats at once.
+
+    Lines are the same as those made by `make_stats_line`, but are
+    formatted straight from stream columns.
+    """
+    yield header_line(repo, stream) + '\n'
+    columns = stream.columns()
+    for start in xrange(0, len(columns), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        yield ''.join(imap('%s %s\n'.__mod__,
+                           izip(columns.x[start:end], columns.y[start:end])))
+
+def split_series(res):
+    """
+    Yield tuples with repositories and streams from `res`, replacing
+    streams of several series (see `processing.SeriesStream`) with a
+    stream per series.
+
+    Series label is appended to stream name and stored in its
+    ``meta`` under ``series`` key.
+
+    Streams which are not evaluated yet are left alone unless their
+    last filter makes several series.
+    """
+    for (repo, stream) in res:
+        stages = stream_stages(stream)
+        if not (isinstance(stream, ColumnStream) or
+                stages and isinstance(stages[-1], SeriesStream)):
+            yield repo, stream
+            continue
+        columns = stream.columns()
+        if not columns.series:
+            yield repo, stream
+            continue
+        for (label, series) in columns.split():
+            meta = dict(getattr(stream, 'meta', {}), series=label)
+            yield repo, ColumnStream.from_columns('%s-%s' % (stream, label),
+                                                  series, meta)
+
+def aggregate_results(res, acc=False):
+    """
+    Return a list of tuples with `helpers.RepoStub` named ``all`` and
+    a stream merging streams of all repositories from `res` (see
+    `processing.MergeStream`), for every pipespec and series.
+
+    If `acc` is True, merged values are accumulated, otherwise they
+    are summed only.
+
+    Streams from `res` are only grouped here. Streams which are not
+    evaluated yet (like those built by `pipespec.PlanSet`) are
+    evaluated when merged stream is, pulling one item of every
+    repository at a time.
+    """
+    keys, groups = [], {}
+    for (repo, stream) in split_series(res):
+        meta = getattr(stream, 'meta', {})
+        key = (meta.get('pipespec', getattr(stream, 'pipespec', None)),
+               meta.get('series'))
+        if key not in groups:
+            keys.append(key)
+            # Stream name without repository name
+            groups[key] = (str(stream)[len(get_repo_name(repo)):], [])
+        groups[key][1].append(stream)
+    merged = []
+    for key in keys:
+        suffix, streams = groups[key]
+        stream = ColumnStream(MergeStream(streams, acc, 'all' + suffix))
+        pipespec, label = key
+        stream.meta = {'aggregate': acc and 'acc' or 'sum',
+                       'repos': len(streams)}
+        if pipespec:
+            stream.meta['pipespec'] = pipespec
+        if label:
+            stream.meta['series'] = label
+        merged.append((RepoStub('all'), stream))
+    return merged
+
+## Compressed files
+
+class ZstdFile():
+    """
+    Write-only file object compressing data with zstd.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.writer = zstandard.ZstdCompressor().stream_writer(fileobj)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+
+# Map compression names to file name suffixes and functions which wrap
+# file objects
+compressors = {
+    'gzip': ('.gz', lambda f: gzip.GzipFile(fileobj=f, mode='wb', filename='')),
+    'zstd': ('.zst', ZstdFile)
+    }
+
+def check_compression(compress):
+    """
+    Raise `UnknownCompression` if compression method `compress` may
+    not be used.
+    """
+    if compress and compress not in compressors:
+        raise UnknownCompression('Unknown compression %s' % compress)
+    if compress == 'zstd' and not zstandard:
+        raise UnknownCompression('zstd compression needs zstandard module')
+
+def unique_name(name, used):
+    """
+    Return `name` made safe for file names, adding a numeric suffix if
+    it's already in `used` set, and remember it there.
+
+    Streams for several pipespecs over one repository may have equal
+    names, since stream names omit filter arguments.
+
+    >>> used = set()
+    >>> [unique_name(n, used) for n in ['r-AccFilter', 'r-AccFilter', 'r']]
+    ['r-AccFilter', 'r-AccFilter-2', 'r']
+    >>> unique_name('r-AuthorFilter-Foo Bar <foo@example.com>', used)
+    'r-AuthorFilter-Foo_Bar_foo@example.com'
+    """
+    name = _unsafe.sub('_', name).strip('_')
+    unique, n = name, 1
+    while unique in used:
+        n += 1
+        unique = '%s-%d' % (name, n)
+    used.add(unique)
+    return unique
+
+class StatsFile():
+    """
+    Text file with stats which is written atomically, possibly
+    compressed with `compress` method.
+    """
+    def __init__(self, file_name, compress=None):
+        check_compression(compress)
+        if compress:
+            suffix, wrapper = compressors[compress]
+            file_name += suffix
+        self.name = file_name
+        self.atomic_file = AtomicFile(file_name)
+        self.file = compress and wrapper(self.atomic_file.file) or self.atomic_file
+
+    def write_stats(self, repo, stream):
+        for block in stats_blocks(repo, stream):
+            self.file.write(block)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        if self.file is not self.atomic_file:
+            self.file.close()
+        self.atomic_file.close()
+
+    def discard(self):
+        self.atomic_file.discard()
+
 ## Each class constructor must accept at least a list of tuples with
 ## repos and their stats and a boolean `combine` argument. Calling
 ## instance must DTRT.
@@ -44,48 +233,92 @@ class Output():
         self.res = res
         self.combine = combine
 
+    def results(self):
+        """
+        Return iterator over tuples with repositories and streams to be
+        written, with several series split (see `split_series`).
+
+        Instances made with a list may be called several times.
+        """
+        return split_series(self.res)
+
 class PrintOutput(Output):
     def __call__(self):
         """
         Print all data lists to stdout.
         """
-        for (repo, stream) in self.res:
-            print header_line(repo, stream)
-            for item in stream:
-                print make_stats_line(item)
-            print '\n'
+        for (repo, stream) in self.results():
+            for block in stats_blocks(repo, stream):
+                sys.stdout.write(block)
+            sys.stdout.write('\n\n')
         return 'Data printed'
 
 class FileOutput(Output):
+    def __init__(self, res, combine=True, compress=None):
+        """
+        Files are compressed with `compress` method (see
+        `compressors`), if it's given.
+        """
+        Output.__init__(self, res, combine)
+        self.compress = compress
+
     def __call__(self):
         """
         Write one or several files, return list of file names written.
         """
         output = []
+        used = set()
+        stats_file = None
         # Writing to one file
         if self.combine:
-            file_name = STATS_BASENAME
-            output = [file_name]
-            # TODO Handle exception
-            os.remove(file_name)
-            stats_file = open(file_name, 'a+')
-        for (repo, stream) in self.res:
-            # Writing to several files
-            if not self.combine:
-                file_name = "%s-%s" % (STATS_BASENAME, stream)
-                stats_file = open(file_name, 'w')
-            stats_file.write(header_line(repo, stream) + '\n')
-            for item in stream:
-                stats_file.write(make_stats_line(item) + '\n')
-            if self.combine:
-                # Separate data lists for different streams with double
-                # newline (gnuplot likes it)
-                stats_file.write('\n\n')
-            else:
-                stats_file.close()
-                output += [file_name]
+            stats_file = StatsFile(STATS_BASENAME, self.compress)
+        try:
+            for (repo, stream) in self.results():
+                # Writing to several files
+                if not self.combine:
+                    name = unique_name(str(stream), used)
+                    stats_file = StatsFile("%s-%s" % (STATS_BASENAME, name),
+                                           self.compress)
+                stats_file.write_stats(repo, stream)
+                if self.combine:
+                    # Separate data lists for different streams with
+                    # double newline (gnuplot likes it)
+                    stats_file.write('\n\n')
+                else:
+                    stats_file.close()
+                    output += [stats_file.name]
+        except:
+            if stats_file:
+                stats_file.discard()
+            raise
         if self.combine:
             stats_file.close()
+            output = [stats_file.name]
+        return output
+
+class BinaryOutput(Output):
+    def __call__(self):
+        """
+        Write one or several binary files (see `binfile`), return list
+        of file names written.
+        """
+        series = []
+        for (repo, stream) in self.results():
+            header = {'repo': get_repo_name(repo), 'root': repo.root,
+                      'name': str(stream)}
+            header.update(getattr(stream, 'meta', {}))
+            series.append((header, stream.columns()))
+        if self.combine:
+            file_name = STATS_BASENAME + '.bin'
+            write_binary(file_name, series)
+            return [file_name]
+        output = []
+        used = set()
+        for (header, columns) in series:
+            file_name = "%s-%s.bin" % (STATS_BASENAME,
+                                       unique_name(header['name'], used))
+            write_binary(file_name, [(header, columns)])
+            output.append(file_name)
         return output
 
 class GchartOutput(Output):
@@ -94,8 +327,12 @@ class GchartOutput(Output):
         Print a list of URLs for Google Chart images with data plots.
         """
         if self.combine:
-            print gchart_url_stats(self.res)
+            print gchart_url_stats(list(self.results()))
         else:
-            for (repo, stream) in self.res:
+            for (repo, stream) in self.results():
                 print gchart_url_stats([(repo, stream)])
         return 'URLs generated'
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
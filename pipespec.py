@@ -3,8 +3,40 @@ Description
 ===========
 
 This module provides `parse_pipespec` function which translates
-textual description of filter sequence to function which applies
-descibed filters to `mercurial.localrepository` objects.
+textual description of filter sequence to a `Plan`, which applies
+descibed filters to `mercurial.localrepository` objects when called.
+
+Compatibility of filters is checked when pipespec is parsed:
+
+>>> parse_pipespec('AccFilter-TagsFilter')
+Traceback (most recent call last):
+  ...
+IncompatibleFilter: TagsFilter may be applied to RepoStream only, not to AccFilter output
+
+Filters making several series (like `AuthorFilter`) must come last:
+
+>>> parse_pipespec('DiffstatFilter-AuthorFilter-AccFilter')
+Traceback (most recent call last):
+  ...
+IncompatibleFilter: AccFilter may not be applied to several series of AuthorFilter output
+
+Plans may be printed to see what will run:
+
+>>> print parse_pipespec('DiffstatFilter(True)-TagsFilter-GroupingFilter(7, 14)-AccFilter')
+RepoStream                 -> repo
+DiffstatFilter(True)  repo -> repo  [fused 1]
+TagsFilter            repo -> repo  [fused 1]
+GroupingFilter(7, 14) repo -> stat
+AccFilter             stat -> stat
+
+`TagsFilter` applied right to `RepoStream` picks tagged revisions
+by itself and is never fused:
+
+>>> print parse_pipespec('TagsFilter-DiffstatFilter-AccFilter')
+RepoStream          -> repo
+TagsFilter     repo -> repo
+DiffstatFilter repo -> repo  [fused 1]
+AccFilter      stat -> stat  [fused 1]
 
 Author and licensing
 ====================
@@ -16,14 +48,24 @@ http://www.gnu.org/licenses/gpl-2.0.html.
 """
 
 import shlex
+import inspect
 
-from processing import RepoStream
+from processing import RepoStream, RepoFilter, FusedStream, SharedStream
+from processing import IncompatibleFilter
 from processing import GroupingFilter, AccFilter, TagsFilter, DiffstatFilter
+from processing import DownsampleFilter, DropFilter, DateFilter, AuthorFilter
+from processing import PathChurnFilter, HotPathsFilter, SeriesStream
 
 symtable = {
     'AccFilter': AccFilter,
+    'AuthorFilter': AuthorFilter,
+    'DateFilter': DateFilter,
     'DiffstatFilter': DiffstatFilter,
+    'DownsampleFilter': DownsampleFilter,
+    'DropFilter': DropFilter,
     'GroupingFilter': GroupingFilter,
+    'HotPathsFilter': HotPathsFilter,
+    'PathChurnFilter': PathChurnFilter,
     'TagsFilter': TagsFilter
     }
 
@@ -39,6 +81,9 @@ class BadArgument(Error):
 class UnexpectedEnd(Error):
     pass
 
+class BadReference(Error):
+    pass
+
 def _read_args(shlex_obj):
     """
     Read pipespec filter arguments from `shlex_obj` tokens.
@@ -89,45 +134,366 @@ def _read_args(shlex_obj):
         return args
     raise UnexpectedEnd
 
+class Stage():
+    """
+    Filter application in a `Plan`.
+    """
+    def __init__(self, name, args):
+        self.name = name
+        self.cls = symtable[name]
+        self.args = args
+        # Number of pipespec which results are joined by filter
+        self.target = None
+        if self.cls.joins:
+            if not args:
+                raise BadReference('%s needs number of another pipespec' % name)
+            self.target = args[0]
+        # Kinds of streams accepted and produced by filter
+        if issubclass(self.cls, RepoFilter):
+            self.input_kind = 'repo'
+        else:
+            self.input_kind = 'stat'
+        if issubclass(self.cls, RepoStream):
+            self.output_kind = 'repo'
+        elif issubclass(self.cls, SeriesStream):
+            self.output_kind = 'series'
+        else:
+            self.output_kind = 'stat'
+
+    def __str__(self):
+        if self.args:
+            return '%s(%s)' % (self.name, ', '.join(map(str, self.args)))
+        return self.name
+
+    def options(self, settings):
+        """
+        Return dictionary of keyword arguments for filter constructor
+        taken from `settings` (see `Plan`), leaving out those given in
+        pipespec.
+        """
+        if not (self.cls.options and settings):
+            return {}
+        names = inspect.getargspec(self.cls.__init__)[0]
+        # Positional arguments follow instance and stream
+        given = len(self.args) + 2
+        return dict((name, settings[name]) for name in self.cls.options
+                    if name in settings and names.index(name) >= given)
+
+    def __call__(self, stream, target=None, settings=None):
+        """
+        Apply filter to `stream`. `target` is the stream of pipespec
+        referred to by filter, if it joins one. Filter options are
+        taken from `settings`.
+        """
+        kwargs = self.options(settings)
+        if self.target is None:
+            return self.cls(stream, *self.args, **kwargs)
+        if target is None:
+            raise BadReference('%s may be used along with other pipespecs only'
+                               % self.name)
+        return self.cls(stream, target, *self.args[1:], **kwargs)
+
+class Plan():
+    """
+    Sequence of filter applications, described by pipespec.
+
+    Calling a plan with repository (and optional keyword arguments
+    for `RepoStream` constructor) returns a stream with filters
+    applied. Neighbouring filters which may work item by item are
+    fused to run in a single loop when stream is iterated over;
+    column-wise evaluation still runs filters one by one.
+    """
+    def __init__(self, stages, pipespec=None, settings=None):
+        """
+        Construct plan from a list of `Stage` objects, checking that
+        all filters may be applied to output of previous ones.
+
+        `pipespec` is the source text of plan. It's stored under
+        ``pipespec`` attribute of streams built by plan.
+
+        `settings` is a dictionary of filter options set for the whole
+        run, like ``workers`` of `DiffstatFilter`. They are passed as
+        keyword arguments to constructors of filters which list them
+        in ``options`` attribute, unless given in pipespec.
+        """
+        kind, prev = 'repo', 'RepoStream'
+        for stage in stages:
+            if kind == 'series':
+                raise IncompatibleFilter('%s may not be applied to several series '
+                                         'of %s output' % (stage.name, prev))
+            if stage.input_kind == 'repo' and not kind == 'repo':
+                raise IncompatibleFilter('%s may be applied to RepoStream only, '
+                                         'not to %s output' % (stage.name, prev))
+            kind, prev = stage.output_kind, stage.name
+        self.stages = stages
+        self.pipespec = pipespec
+        self.settings = settings or {}
+
+    def __call__(self, repo, **kwargs):
+        streams = [RepoStream(repo, **kwargs)]
+        for stage in self.stages:
+            streams.append(stage(streams[-1], None, self.settings))
+        stream = self._fuse(streams)
+        stream.pipespec = self.pipespec
+        return stream
+
+    def _fuse(self, streams, unfused=()):
+        """
+        Replace groups of fusable filters in `streams` chain with
+        `FusedStream` instances, return the last stream. Filters with
+        indexes from `unfused` are left alone.
+
+        Filters are constructed unfused, so that each one checks its
+        actual input; fused groups are inserted afterwards.
+        """
+        for group in self.fused_groups(streams, unfused):
+            fused = FusedStream([streams[i] for i in group])
+            if group[-1] == len(streams) - 1:
+                streams.append(fused)
+            else:
+                streams[group[-1] + 1].stream = fused
+        return streams[-1]
+
+    def fused_groups(self, streams=None, unfused=()):
+        """
+        Return list of lists with indexes of filters to be fused
+        (index 0 is for `RepoStream`), except those from `unfused`.
+
+        If `streams` is not given, only filter classes are checked.
+        """
+        groups, group = [], []
+        for i in xrange(1, len(self.stages) + 1):
+            if i in unfused:
+                fusable = False
+            elif streams:
+                fusable = streams[i].fusable()
+            else:
+                stage = self.stages[i - 1]
+                fusable = stage.cls.can_fuse(*stage.args,
+                                             **stage.options(self.settings)) and \
+                          not (i == 1 and stage.cls.reads_source)
+            if fusable:
+                group.append(i)
+            else:
+                if len(group) > 1:
+                    groups.append(group)
+                group = []
+        if len(group) > 1:
+            groups.append(group)
+        return groups
+
+    def stable(self):
+        """
+        Return True if results of plan may be kept until repository
+        changes: all filters may be continued with new revisions (see
+        `processing.StreamFilter.resumable`) and none depends on
+        current time.
+        """
+        for stage in self.stages:
+            if not stage.cls.resumable or stage.cls.depends_on_time(*stage.args):
+                return False
+        return True
+
+    def __str__(self):
+        return self.explain()
+
+    def explain(self, index=None):
+        """
+        Return a table with plan stages.
+
+        If `index` (`cache.RepoIndex` of repository) is given,
+        estimated number of items and relative cost are shown for
+        every stage. Groups of filters marked with ``[fused N]`` run
+        in a single loop when items are iterated over.
+        """
+        groups = self.fused_groups()
+        def fused_mark(i):
+            for n, group in enumerate(groups):
+                if i in group:
+                    return '  [fused %d]' % (n + 1)
+            return ''
+        names = ['RepoStream'] + map(str, self.stages)
+        width = max(map(len, names))
+        lines = []
+        count = index is not None and len(index) or 0
+        for i, name in enumerate(names):
+            if i == 0:
+                line = '%s %s -> repo' % (name.ljust(width), ' ' * 4)
+                cost = count
+            else:
+                stage = self.stages[i - 1]
+                line = '%s %s -> %s' % (name.ljust(width), stage.input_kind,
+                                        stage.output_kind)
+                cost = count * stage.cls.cost
+                if index is not None:
+                    count = stage.cls.estimate(count, index, *stage.args)
+                    # Source is read right away, only for items produced
+                    if i == 1 and stage.cls.reads_source:
+                        cost = count * stage.cls.cost
+            if index is not None:
+                line += '  items ~%d, cost ~%d' % (count, cost)
+            lines.append(line + fused_mark(i))
+        return '\n'.join(lines)
+
+class PlanSet():
+    """
+    Several plans evaluated over the same repository together.
+
+    Stages with the same prefix in different plans (like
+    ``DiffstatFilter`` in ``DiffstatFilter-AccFilter`` and
+    ``DiffstatFilter-GroupingFilter``) are built once, so plans form
+    a tree rooted at a single `RepoStream`. Streams used by several
+    consumers are wrapped in `SharedStream` proxies which evaluate them
+    once, and are never fused with neighbouring filters.
+
+    Filters which join another stream (like `DropFilter`) refer to
+    results of one of the previous plans by its number, counting from
+    1:
+
+    >>> PlanSet(map(parse_pipespec, ['TagsFilter-DropFilter(2)', 'AccFilter']))
+    Traceback (most recent call last):
+      ...
+    BadReference: DropFilter(2) in pipespec 1 may only refer to previous pipespecs
+    """
+    def __init__(self, plans, target_repo=None):
+        """
+        If `target_repo` is given, plans referred to by joining
+        filters are evaluated over that repository (once for all
+        calls) rather than over the repository the set is called with.
+        """
+        for n, plan in enumerate(plans):
+            for stage in plan.stages:
+                if stage.target is None:
+                    continue
+                if not 1 <= stage.target <= n:
+                    raise BadReference('%s in pipespec %d may only refer to '
+                                       'previous pipespecs' % (stage, n + 1))
+                if plans[stage.target - 1].stages and \
+                   plans[stage.target - 1].stages[-1].output_kind == 'series':
+                    raise IncompatibleFilter('%s may not join several series '
+                                             'of pipespec %d' % (stage, stage.target))
+        self.plans = plans
+        self.target_repo = target_repo
+        self._targets = {}
+
+    def _target(self, n):
+        """
+        Return shared stream with results of plan `n` over target
+        repository.
+        """
+        if n not in self._targets:
+            stream = PlanSet(self.plans[:n + 1])(self.target_repo)[n]
+            if not isinstance(stream, SharedStream):
+                stream = SharedStream(stream)
+            self._targets[n] = stream
+        return self._targets[n]
+
+    def __call__(self, repo, **kwargs):
+        """
+        Return a list of streams with results of all plans, in order.
+        """
+        # Streams and their consumers (next streams or plan numbers
+        # for final ones) by stage prefix
+        nodes = {(): RepoStream(repo, **kwargs)}
+        users = {}
+        chains = []
+        shared = {}
+        for n, plan in enumerate(self.plans):
+            keys = [()]
+            for stage in plan.stages:
+                key = keys[-1] + (str(stage),)
+                if key not in nodes:
+                    target = None
+                    if stage.target is not None and self.target_repo is not None:
+                        target = self._target(stage.target - 1)
+                    elif stage.target is not None:
+                        # Joined results are used by plan too
+                        end = chains[stage.target - 1][-1]
+                        users[end].add(key)
+                        if end not in shared:
+                            shared[end] = SharedStream(nodes[end])
+                        target = shared[end]
+                    nodes[key] = stage(nodes[keys[-1]], target, plan.settings)
+                users.setdefault(keys[-1], set()).add(key)
+                keys.append(key)
+            users.setdefault(keys[-1], set()).add(n)
+            chains.append(keys)
+
+        for key, stream in nodes.iteritems():
+            if len(users[key]) > 1 and key not in shared:
+                shared[key] = SharedStream(stream)
+        for key, stream in nodes.iteritems():
+            if key and key[:-1] in shared:
+                stream.stream = shared[key[:-1]]
+
+        res = []
+        for plan, keys in zip(self.plans, chains):
+            stream = plan._fuse([nodes[key] for key in keys],
+                                [i for (i, key) in enumerate(keys) if key in shared])
+            if keys[-1] in shared:
+                stream = shared[keys[-1]]
+            stream.pipespec = plan.pipespec
+            res.append(stream)
+        return res
+
+    def builder(self, n):
+        """
+        Return a function which builds the stream of plan `n` when
+        called like a `Plan`, along with streams of plans it refers
+        to.
+        """
+        return lambda repo, **kwargs: self(repo, **kwargs)[n]
+
+    def __iter__(self):
+        return iter(self.plans)
+
+    def __len__(self):
+        return len(self.plans)
+
 def _read_filter(shlex_obj):
     """
     Read next filter specifier (with arguments) from `shlex_obj` tokens
-    and return function.
+    and return `Stage` object.
     """
     filter_name = shlex_obj.get_token()
     if filter_name == '':
         return False
     elif symtable.has_key(filter_name):
         args = _read_args(shlex_obj)
-        return lambda s: symtable[filter_name](s, *args)
+        return Stage(filter_name, args)
     else:
         raise UnknownFilter(filter_name)
 
-def _read_pipespec(shlex_obj, filters):
+def _read_pipespec(shlex_obj):
     """
-    Read next filter description from `shlex_obj` and compose it with
-    `filters` function.
+    Read all filter descriptions from `shlex_obj`, return a list of
+    `Stage` objects.
     """
+    stages = []
     cur_filter = _read_filter(shlex_obj)
-    if cur_filter:
-        return _read_pipespec(shlex_obj, lambda s: cur_filter(filters(s)))
-    else:
-        return filters
+    while cur_filter:
+        stages.append(cur_filter)
+        cur_filter = _read_filter(shlex_obj)
+    return stages
 
-def parse_pipespec(pipespec):
+def parse_pipespec(pipespec, settings=None):
     """
-    Return a function, which performs a sequence of filter
-    applications as described in `pipespec` string.
+    Return a `Plan` which performs a sequence of filter applications
+    as described in `pipespec` string when called with repository.
+    Filter options are taken from `settings` dictionary (see `Plan`).
 
     Pipespec is a dash-separated list of compatible filters to be
     applied to repository.
 
     Available filters are listed in `symtable`.
+
+    Keyword arguments of plan call (like `from_rev` and `to_rev`) are
+    passed to `RepoStream` constructor.
     """
     shlex_obj = shlex.shlex(pipespec)
     # We just ignore all dashes
     shlex_obj.whitespace += '-'
-    return _read_pipespec(shlex_obj, RepoStream)
+    return Plan(_read_pipespec(shlex_obj), pipespec, settings)
 
 if __name__ == "__main__":
     import doctest
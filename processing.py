@@ -28,6 +28,11 @@ processing.
 
 Iterate over filtered streams for further data processing.
 
+Large streams may also be evaluated column-wise, which produces
+compact `Columns` instead of an item object per changeset:
+
+>>> cols = s_f.columns()
+
 Author and licensing
 ====================
 
@@ -37,12 +42,21 @@ This code is subject to GNU GPL version 2 license, as can be read on
 http://www.gnu.org/licenses/gpl-2.0.html.
 """
 
+import os
+import re
+import time
+import heapq
 import datetime
+import multiprocessing
+from array import array
+from itertools import izip
+from bisect import bisect_left, bisect_right
 
 from mercurial.localrepo import localrepository
-from mercurial import patch
+from mercurial import hg, ui, patch, util, match
 
 from helpers import get_repo_name
+from cache import DiffstatCache, FileDiffstatCache, RepoIndex
 
 ## Exceptions
 
@@ -58,6 +72,15 @@ class IncompatibleFilter(Error):
 class UnsyncedStreams(Error):
     pass
 
+class StaleState(Error):
+    pass
+
+class UnorderedStream(Error):
+    pass
+
+class BadAliases(Error):
+    pass
+
 ## Statistics items
 
 def std_x_label(item):
@@ -66,7 +89,7 @@ def std_x_label(item):
 def std_y_label(item):
     return str(item.y)
 
-class StatItem():
+class StatItem(object):
     """
     Represents a single item in repository statistics.
     """
@@ -92,6 +115,12 @@ class StatItem():
         return ' '.join(map(lambda l: callable(l) and l(self) or l,\
                             [self.x_label, self.y_label]))
 
+    def points(self):
+        """
+        Return a list of ``(x, y)`` tuples to be plotted for item.
+        """
+        return [(self.x, self.y)]
+
     def _copy_dic(self):
         return {'x': self.x,
                 'y': self.y,
@@ -107,30 +136,158 @@ class StatItem():
         d.update(**kwargs)
         return self.__class__(**d)
 
+class SpanStatItem(StatItem):
+    """
+    Stands for a run of items with equal ``y`` values, from ``x``
+    through ``x_end``.
+
+    Such item is printed and plotted as its two ends.
+    """
+    def __init__(self, x, y, x_end, x_label=None, y_label=None):
+        StatItem.__init__(self, x, y, x_label, y_label)
+        self.x_end = x_end
+
+    def __repr__(self):
+        return '%s\n%s' % (StatItem.__repr__(self),
+                           StatItem.__repr__(self.child(x=self.x_end)))
+
+    def points(self):
+        return [(self.x, self.y), (self.x_end, self.y)]
+
+    def _copy_dic(self):
+        d = StatItem._copy_dic(self)
+        d['x_end'] = self.x_end
+        return d
+
 class CtxStatItem(StatItem):
     """
-    Wraps change context in a `StatItem` instance.
+    Binds changeset to a `StatItem` instance.
     """
-    def __init__(self, ctx, *args, **kwargs):
+    def __init__(self, rev, index, *args, **kwargs):
         """
         Construct a new `CtxStatItem` instance.
 
-        `ctx` must be an instance of `mercurial.context.changectx`
-        class and will be stored under ``ctx`` attribute. ``datetime``
-        attribute will be set to datetime object built from changeset
-        date.
+        `rev` is changeset revision number and `index` must be
+        `cache.RepoIndex` of its repository. Both are stored under
+        attributes of the same names, so that filters may read
+        changeset metadata from index.
+
+        ``ctx`` and ``datetime`` attributes are built from them when
+        requested.
 
         `args` and `kwargs` are passed to `StatItem` constructor.
         """
         StatItem.__init__(self, *args, **kwargs)
-        self.ctx = ctx
-        self.datetime = datetime.datetime.fromtimestamp(ctx.date()[0])
+        self.rev = rev
+        self.index = index
+
+    @property
+    def ctx(self):
+        """`mercurial.context.changectx` instance for changeset."""
+        return self.index.repo[self.rev]
+
+    @property
+    def datetime(self):
+        """Changeset date as `datetime` object."""
+        return datetime.datetime.fromtimestamp(self.index.date[self.rev])
 
     def _copy_dic(self):
         d = StatItem._copy_dic(self)
-        d['ctx'] = self.ctx
+        d['rev'] = self.rev
+        d['index'] = self.index
         return d
 
+## Columns store many items compactly
+
+def _typecode(values):
+    """
+    Return `array` typecode suitable for storing all `values`.
+    """
+    for v in values:
+        if not isinstance(v, (int, long)):
+            return 'd'
+    return 'l'
+
+class Columns():
+    """
+    Stores ``x`` and ``y`` values of stream items in typed arrays.
+
+    ``rev`` array holds changeset revision numbers of items (-1 for
+    items not bound to changesets), so that filters may look up
+    changeset data without keeping change contexts around.
+
+    Columns of `SeriesStream` hold several series one after another,
+    ``series`` is a list of ``(label, count)`` tuples for them then.
+    """
+    series = None
+
+    def __init__(self, x=None, y=None, rev=None, series=None):
+        if x is None:
+            x = array('d')
+        if y is None:
+            y = array('l')
+        if rev is None:
+            rev = array('l')
+        self.x, self.y, self.rev = x, y, rev
+        if series is not None:
+            self.series = series
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Build columns from an iterable of `StatItem` objects.
+        """
+        xs, ys, revs = [], [], array('l')
+        for item in items:
+            xs.append(item.x)
+            ys.append(item.y)
+            revs.append(getattr(item, 'rev', -1))
+        return cls(array(_typecode(xs), xs), array(_typecode(ys), ys), revs)
+
+    def __len__(self):
+        return len(self.x)
+
+    def items(self):
+        """
+        Yield `StatItem` objects for all rows.
+        """
+        for i in xrange(len(self.x)):
+            yield StatItem(x=self.x[i], y=self.y[i])
+
+    def concat(self, other):
+        """
+        Return new columns with rows of `other` columns appended.
+        """
+        def join(a, b):
+            if a.typecode == b.typecode or not b:
+                return a + array(a.typecode, b)
+            if not a:
+                return array(b.typecode, a) + b
+            return array('d', a) + array('d', b)
+        return Columns(join(self.x, other.x), join(self.y, other.y),
+                       self.rev + other.rev)
+
+    def take(self, indices):
+        """
+        Return new columns with rows at `indices` only.
+        """
+        return Columns(array(self.x.typecode, [self.x[i] for i in indices]),
+                       array(self.y.typecode, [self.y[i] for i in indices]),
+                       array('l', [self.rev[i] for i in indices]))
+
+    def split(self):
+        """
+        Return a list of ``(label, columns)`` tuples for all series
+        (label is None if there's only one).
+        """
+        res, start = [], 0
+        for (label, count) in self.series or [(None, len(self))]:
+            end = start + count
+            res.append((label, Columns(self.x[start:end], self.y[start:end],
+                                       self.rev[start:end])))
+            start = end
+        return res
+
 ## Streams form sequences of StatItems
 
 class StatStream():
@@ -149,6 +306,60 @@ class StatStream():
     def __iter__(self):
         return iter(self.stream)
 
+    def columns(self):
+        """
+        Return `Columns` with all items of the stream.
+
+        Streams which can compute their data column-wise override
+        this to avoid creating an object per item.
+        """
+        return Columns.from_items(iter(self))
+
+class ColumnStream(StatStream):
+    """
+    Stream which evaluates another stream column-wise once and keeps
+    the result in compact `Columns`.
+
+    ``meta`` dictionary describes where the data came from: it may
+    contain ``pipespec`` and revision range (``from_rev`` and
+    ``to_rev``).
+    """
+    def __init__(self, stream):
+        StatStream.__init__(self, stream)
+        self.name = str(stream)
+        self._columns = None
+        self.meta = {}
+        stages = stream_stages(stream)
+        if stages and isinstance(stages[0], RepoStream):
+            self.meta['from_rev'] = stages[0].from_rev
+            self.meta['to_rev'] = stages[0].to_rev
+        if getattr(stream, 'pipespec', None):
+            self.meta['pipespec'] = stream.pipespec
+
+    @classmethod
+    def from_columns(cls, name, columns, meta=None):
+        """
+        Make a stream of already computed `columns`, named `name`.
+        """
+        stream = cls(name)
+        stream._columns = columns
+        stream.meta = meta or {}
+        return stream
+
+    def columns(self):
+        if self._columns is None:
+            self._columns = self.stream.columns()
+        return self._columns
+
+    def __iter__(self):
+        return self.columns().items()
+
+    def __len__(self):
+        return len(self.columns())
+
+    def __str__(self):
+        return self.name
+
 class RepoStream(StatStream):
     """
     Stream of change contexts in a repository, represented by
@@ -182,16 +393,287 @@ class RepoStream(StatStream):
         self.to_rev = to_rev or len(self.stream)-1
 
     def __iter__(self):
-        for rev in xrange(self.from_rev, self.to_rev + 1):
-            ctx = self.stream[rev]
-            yield CtxStatItem(ctx, x=ctx.date()[0], y=1)
+        return self.rev_items(xrange(self.from_rev, self.to_rev + 1))
 
     def __len__(self):
         return self.to_rev - self.from_rev + 1
 
+    def columns(self):
+        revs = array('l', xrange(self.from_rev, self.to_rev + 1))
+        x = self.get_index().date[self.from_rev:self.to_rev + 1]
+        y = array('l', [1]) * len(revs)
+        return Columns(x, y, revs)
+
+    def rev_items(self, revs):
+        """
+        Yield items for revisions from `revs` only, as if all other
+        were filtered out.
+        """
+        index = self.get_index()
+        for rev in revs:
+            yield CtxStatItem(rev, index, x=index.date[rev], y=1)
+
+    def rev_columns(self, revs):
+        """
+        Return columns for revisions from `revs` only.
+        """
+        date = self.get_index().date
+        revs = array('l', revs)
+        return Columns(array('d', [date[rev] for rev in revs]),
+                       array('l', [1]) * len(revs), revs)
+
+    def get_source(self):
+        """
+        Return `RepoStream` instance at the beginning of filter chain.
+        """
+        if isinstance(self.stream, localrepository):
+            return self
+        return self.stream.get_source()
+
+    def get_repo(self):
+        """
+        Return repository which the stream was built from.
+        """
+        return self.get_source().stream
+
+    def get_index(self):
+        """
+        Return `cache.RepoIndex` of repository.
+        """
+        return RepoIndex.get(self.get_repo())
+
     def __str__(self):
         return get_repo_name(self.stream)
 
+class SeriesStream(StatStream):
+    """
+    Stream of several series of items, one after another. Items have
+    ``series`` attribute set to label of their series, and so do
+    `Columns` of the stream.
+
+    Filters which produce several series must be derived from this
+    class. No filters may be applied to such streams, as they would
+    mix series together.
+    """
+    pass
+
+def series_items(series):
+    """
+    Yield `StatItem` objects with ``series`` attribute for all
+    ``(label, points)`` tuples from `series`, where points is a list
+    of ``(x, y)`` tuples.
+    """
+    for (label, points) in series:
+        for (x, y) in points:
+            item = StatItem(x=x, y=y)
+            item.series = label
+            yield item
+
+def series_columns(series):
+    """
+    Return `Columns` with all points of `series` (see
+    `series_items`).
+    """
+    xs, ys = [], []
+    for (label, points) in series:
+        for (x, y) in points:
+            xs.append(x)
+            ys.append(y)
+    return Columns(array(_typecode(xs), xs), array(_typecode(ys), ys),
+                   array('l', [-1]) * len(xs),
+                   [(label, len(points)) for (label, points) in series])
+
+class StreamProxy(StatStream):
+    """
+    Base class for wrappers which may be inserted between filters to
+    watch them. All attributes are taken from the wrapped stream.
+    """
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __str__(self):
+        return str(self.stream)
+
+    def columns(self):
+        return self.stream.columns()
+
+def stream_stages(stream):
+    """
+    Return a list of all streams in filter chain which ends with
+    `stream`, starting with the source one.
+
+    Proxies are not included.
+    """
+    stages = []
+    while isinstance(stream, StatStream):
+        if not isinstance(stream, StreamProxy):
+            stages.insert(0, stream)
+        stream = stream.stream
+    return stages
+
+class FusedStream(StreamProxy):
+    """
+    Runs a sequence of filters applied on top of each other in a
+    single loop, using their mappers (see `StreamFilter.mapper`),
+    when iterated over.
+
+    Column-wise evaluation is left to the filters themselves, which
+    need no item objects at all.
+    """
+    def __init__(self, stages):
+        """
+        `stages` is a list of filters, each one applied to the
+        previous one.
+        """
+        StreamProxy.__init__(self, stages[-1])
+        self.stages = stages
+
+    def __iter__(self):
+        mappers = [stage.mapper() for stage in self.stages]
+        try:
+            for item in self.stages[0].stream:
+                for convert in mappers:
+                    item = convert(item)
+                    if item is None:
+                        break
+                else:
+                    yield item
+        finally:
+            for stage in self.stages:
+                stage.finish()
+
+class SharedStream(StreamProxy):
+    """
+    Evaluates wrapped stream once for several consumers, keeping its
+    columns only.
+
+    Consumers which iterate over the stream get items made from the
+    columns; items of filters preserving change contexts are
+    `CtxStatItem` objects again.
+    """
+    def __init__(self, stream):
+        StreamProxy.__init__(self, stream)
+        self._columns = None
+
+    def __iter__(self):
+        cols = self.columns()
+        stage = stream_stages(self)[-1]
+        if not isinstance(stage, RepoStream):
+            return cols.items()
+        index = stage.get_index()
+        return (CtxStatItem(cols.rev[i], index, x=cols.x[i], y=cols.y[i])
+                for i in xrange(len(cols)))
+
+    def columns(self):
+        if self._columns is None:
+            self._columns = self.stream.columns()
+        return self._columns
+
+class MergeStream(StatStream):
+    """
+    Merges several streams ordered by ``x`` into one.
+
+    >>> a = ColumnStream.from_columns('a', Columns(array('l', [1, 3, 5]), array('l', [1, 1, 1])))
+    >>> b = ColumnStream.from_columns('b', Columns(array('l', [2, 3]), array('l', [10, 10])))
+    >>> list(MergeStream([a, b]).columns().y)
+    [1, 10, 11, 1]
+    >>> list(MergeStream([a, b], acc=True).columns().y)
+    [1, 11, 22, 23]
+
+    Streams far out of order are sorted as a whole:
+
+    >>> c = ColumnStream.from_columns('c', Columns(array('l', [4, 3, 2]), array('l', [1, 1, 1])))
+    >>> m = MergeStream([a, c])
+    >>> m.window = 1
+    >>> list(m.columns().x)
+    [1, 2, 3, 4, 5]
+    """
+    # Number of items of every stream kept to put them in order
+    window = 256
+
+    def __init__(self, streams, acc=False, name='all'):
+        """
+        Construct a new `MergeStream` instance which produces an item
+        for every distinct ``x`` of items in `streams`, with ``y`` set
+        to sum of ``y`` of all items with that ``x``. If `acc` is
+        True, ``y`` values are accumulated as well.
+
+        Streams are merged with a k-way merge, which pulls items from
+        all streams one by one, so that streams are never evaluated
+        as a whole. Streams should be ordered by ``x``. As changeset
+        dates may go backwards, items less than `window` positions
+        out of order are put in order. If items are further off,
+        iteration fails with `UnorderedStream`, while `columns`
+        evaluates streams again, sorting every one as a whole.
+
+        Values must be summable: items of changesets or frames
+        (see `GroupingFilter` with ``align`` set) may be merged, but
+        already accumulated ones may not.
+        """
+        StatStream.__init__(self, streams)
+        self.acc = acc
+        self.name = name
+
+    def _pairs(self, stream):
+        """
+        Yield ``(x, y)`` tuples for items of `stream`, ordered by ``x``
+        within a `window` of items.
+        """
+        heap, last_x = [], None
+        for item in stream:
+            if len(heap) < self.window:
+                heapq.heappush(heap, (item.x, item.y))
+                continue
+            pair = heapq.heappushpop(heap, (item.x, item.y))
+            if last_x is not None and pair[0] < last_x:
+                raise UnorderedStream('Items of %s are more than %d positions '
+                                      'out of order' % (stream, self.window))
+            last_x = pair[0]
+            yield pair
+        while heap:
+            yield heapq.heappop(heap)
+
+    def _sorted_pairs(self, stream):
+        """
+        Return sorted list of ``(x, y)`` tuples for items of `stream`.
+        """
+        cols = stream.columns()
+        return sorted(izip(cols.x, cols.y))
+
+    def _merged(self, pairs=None):
+        """
+        Yield ``(x, y)`` tuples of output items, merging ordered
+        ``(x, y)`` tuples made by `pairs` function for every stream
+        (`_pairs` by default).
+        """
+        total, last_x = 0, None
+        for (x, y) in heapq.merge(*map(pairs or self._pairs, self.stream)):
+            if not x == last_x and last_x is not None:
+                yield last_x, total
+                if not self.acc:
+                    total = 0
+            total += y
+            last_x = x
+        if last_x is not None:
+            yield last_x, total
+
+    def __iter__(self):
+        for (x, y) in self._merged():
+            yield StatItem(x=x, y=y)
+
+    def columns(self):
+        try:
+            merged = list(self._merged())
+        except UnorderedStream:
+            merged = list(self._merged(self._sorted_pairs))
+        xs = [x for (x, y) in merged]
+        ys = [y for (x, y) in merged]
+        return Columns(array(_typecode(xs), xs), array(_typecode(ys), ys),
+                       array('l', [-1]) * len(xs))
+
+    def __str__(self):
+        return self.name
+
 ## Filters transform streams, producing another streams
 ##
 ## By convention, all filter classes except StreamFilter and
@@ -209,11 +691,31 @@ class StreamFilter():
     """
     Base class for stream filters.
     """
+    # Relative cost of processing one input item, used to explain
+    # pipespec plans
+    cost = 1
+    # True for filters which pick revisions from `RepoStream` by
+    # themselves when applied right to it (see `direct_source`),
+    # instead of looking at all of its items. They are not fused
+    # with next filters then.
+    reads_source = False
+    # False for filters which need the whole input at once, so that
+    # their results may not be continued using `set_state`
+    resumable = True
+    # True for filters which take another stream as the first
+    # argument; pipespecs give it as the number of another pipespec
+    joins = False
+    # Names of constructor keyword arguments which are set for the
+    # whole run rather than in pipespecs (see `pipespec.Plan`)
+    options = []
+
     def __init__(self, stream):
         StatStream.__init__(self, stream)
         # Check that we apply filter to stream
         if not isinstance(stream, StatStream):
             raise IncompatibleFilter('%s may be applied to StatStream only' % self.__class__)
+        if isinstance(stream, SeriesStream):
+            raise IncompatibleFilter('%s may not be applied to several series' % self.__class__)
 
     def __str__(self):
         """
@@ -222,6 +724,103 @@ class StreamFilter():
         """
         return '%s-%s' % (str(self.stream), self.__class__.__name__)
 
+    def columns(self):
+        # Filters which preserve change contexts are derived from
+        # RepoStream, but must not inherit its columns method
+        return StatStream.columns(self)
+
+    def get_state(self):
+        """
+        Return picklable state of the filter after the last iteration,
+        which may later be passed to `set_state` of a filter built on
+        a stream with subsequent revisions to continue from that
+        point.
+
+        Stateless filters return None.
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Make filter continue from `state` when iterated.
+
+        Raise `StaleState` if `state` may not be continued from
+        because repository has changed.
+        """
+        pass
+
+    def mapper(self):
+        """
+        Return a function which converts an input item to output item
+        (or None to drop it), or None if filter does not work item by
+        item.
+
+        Neighbouring filters which provide mappers may be fused to
+        run in a single loop (see `FusedStream`). `finish` is called
+        when the loop is over.
+        """
+        return None
+
+    @classmethod
+    def can_fuse(cls, *args, **kwargs):
+        """
+        Return True if filter constructed with `args` and `kwargs`
+        will provide `mapper`.
+        """
+        return False
+
+    def fusable(self):
+        """
+        Return True if `mapper` is available and is to be used.
+        """
+        return self.can_fuse() and not (self.reads_source and self.direct_source())
+
+    def direct_source(self):
+        """
+        Return `RepoStream` the filter is applied to right away
+        (possibly through proxies), or None if there are other
+        filters in between.
+        """
+        stream = self.stream
+        while isinstance(stream, StreamProxy):
+            stream = stream.stream
+        if stream.__class__ is RepoStream:
+            return stream
+        return None
+
+    def finish(self):
+        pass
+
+    def _mapped(self):
+        """
+        Iterate over input stream, applying `mapper` to items.
+        """
+        convert = self.mapper()
+        try:
+            for item in self.stream:
+                item = convert(item)
+                if item is not None:
+                    yield item
+        finally:
+            self.finish()
+
+    @classmethod
+    def estimate(cls, count, index, *args):
+        """
+        Return estimated number of items produced from `count` input
+        items of repository with `cache.RepoIndex` `index` by filter
+        constructed with `args`.
+        """
+        return count
+
+    @classmethod
+    def depends_on_time(cls, *args):
+        """
+        Return True if results of filter constructed with `args`
+        depend on current time, not only on its input.
+        """
+        return False
+
 class RepoFilter(StreamFilter):
     """
     Deriving filters from this class makes them fail when applied to
@@ -237,19 +836,206 @@ class AccFilter(StreamFilter, StatStream):
     """
     Accumulates ``y`` values.
     """
-    def __iter__(self):
-        acc = 0
-        for item in self.stream:
-            acc += item.y
+    def __init__(self, stream):
+        StreamFilter.__init__(self, stream)
+        # Initial and reached values of accumulator
+        self.start = self.acc = 0
+
+    @classmethod
+    def can_fuse(cls, *args, **kwargs):
+        return True
+
+    def mapper(self):
+        acc = [self.start]
+        def accumulate(item):
+            acc[0] += item.y
+            self.acc = acc[0]
             # Specify y_label because it will derive from current item
             # otherwise
-            yield item.child(y = acc, y_label=None)
+            return item.child(y = acc[0], y_label=None)
+        return accumulate
+
+    def __iter__(self):
+        return self._mapped()
+
+    def columns(self):
+        cols = self.stream.columns()
+        acc = self.start
+        y = array(cols.y.typecode)
+        for value in cols.y:
+            acc += value
+            y.append(acc)
+        self.acc = acc
+        return Columns(cols.x, y, cols.rev)
+
+    def get_state(self):
+        return self.acc
+
+    def set_state(self, state):
+        self.start = self.acc = state
         
+def snap_date(date):
+    """Snap to beginning of day."""
+    return datetime.datetime(*date.timetuple()[:3]) # It's a lion!
+
+def to_epoch(date):
+    """Convert local `datetime` object to Epoch seconds."""
+    return int(time.mktime(date.timetuple()))
+
+class FrameGrouper():
+    """
+    Sums values of timestamped items over consecutive time frames, as
+    described in `GroupingFilter`.
+
+    Every item is handled once: it is pushed to a heap when its frame
+    is reached and popped when it gets older than relaxation period,
+    while the sum of values in the heap is kept up to date. Thus
+    grouping takes O(n log w) time, where w is the number of items in
+    relaxation period, no matter how many frames there are.
+    """
+    def __init__(self, resolution, relax_days, datemax=None, state=None,
+                 align=False):
+        """
+        Group items by `resolution` days frames up to `datemax` (now
+        by default).
+
+        If `state` is given, grouping continues from the point where
+        `get_state` was called on another instance.
+
+        If `align` is True, frames are counted from Epoch instead of
+        the first item, and the last frame is not cut at `datemax`, so
+        that frames of different streams line up.
+        """
+        self.resolution = resolution
+        self.delta = datetime.timedelta(resolution)
+        self.relax_period = datetime.timedelta(relax_days)
+        self.datemax = datemax or datetime.datetime.now()
+        self.align = align
+        # End of the frame being collected (as datetime and in Epoch
+        # seconds)
+        self.cur_date = None
+        self.frame_end = None
+        # Heap of (timestamp, y) tuples in current group and sum of
+        # their ``y``
+        self.window = []
+        self.total = 0
+        if state:
+            self.cur_date, self.frame_end, window, self.total = state
+            self.window = list(window)
+
+    def get_state(self):
+        return (self.cur_date, self.frame_end, list(self.window), self.total)
+
+    def _next_frame(self):
+        """
+        Drop old items and return ``(x, y)`` tuple for current frame,
+        moving to the next one.
+        """
+        oldest = to_epoch(self.cur_date - self.relax_period)
+        while self.window and self.window[0][0] <= oldest:
+            self.total -= heapq.heappop(self.window)[1]
+        frame = (to_epoch(self.cur_date), self.total)
+        self.cur_date += self.delta
+        # Snap to datemax to prevent skipping items from the last
+        # group
+        if not self.align and self.cur_date > self.datemax and \
+           self.cur_date < self.datemax + self.delta:
+            self.cur_date = self.datemax
+        self.frame_end = to_epoch(self.cur_date)
+        return frame
+
+    def _first_frame(self, timestamp):
+        date = snap_date(datetime.datetime.fromtimestamp(timestamp))
+        if self.align:
+            days = (date.date() - datetime.date(1970, 1, 1)).days
+            date -= datetime.timedelta(days % self.resolution)
+        return date
+
+    def _open(self):
+        """
+        Return True if frame being collected starts before datemax.
+        """
+        if self.align:
+            return self.cur_date - self.delta <= self.datemax
+        return self.cur_date <= self.datemax
+
+    def feed(self, pairs):
+        """
+        Add ``(timestamp, y)`` tuples from `pairs`, yielding ``(x,
+        y)`` tuples for all frames which end before the last item.
+        """
+        for (timestamp, y) in pairs:
+            if self.cur_date is None:
+                self.cur_date = self._first_frame(timestamp)
+                self.frame_end = to_epoch(self.cur_date)
+            # Item belongs to the first frame ending after it and
+            # after all previous items
+            while not timestamp < self.frame_end:
+                if not self._open():
+                    return
+                yield self._next_frame()
+            heapq.heappush(self.window, (timestamp, y))
+            self.total += y
+
+    def flush(self, till_now=True):
+        """
+        Yield all remaining frames up to datemax.
+
+        If `till_now` is False, stop after the first frame with no
+        items left in relaxation period, as all further frames would
+        be empty.
+        """
+        while self.cur_date is not None and self._open():
+            yield self._next_frame()
+            if not till_now and not self.window:
+                return
+
+    def group(self, pairs, till_now=True):
+        """
+        Yield ``(x, y)`` tuples for all frames from the first item in
+        `pairs` up to datemax (see `flush` for `till_now`).
+        """
+        for frame in self.feed(pairs):
+            yield frame
+        for frame in self.flush(till_now):
+            yield frame
+
+def zero_spans(frames):
+    """
+    Collapse runs of consecutive ``(x, y)`` `frames` with zero ``y``
+    into ``(x, 0, x_end)`` tuples. Other frames are yielded as ``(x, y,
+    None)``.
+
+    >>> list(zero_spans([(1, 0), (2, 3), (3, 0), (4, 0), (5, 0), (6, 1)]))
+    [(1, 0, None), (2, 3, None), (3, 0, 5), (6, 1, None)]
+    """
+    def span(start, end, count):
+        if count > 1:
+            return (start, 0, end)
+        return (start, 0, None)
+
+    start = end = None
+    count = 0
+    for (x, y) in frames:
+        if y == 0:
+            if not count:
+                start = x
+            end = x
+            count += 1
+            continue
+        if count:
+            yield span(start, end, count)
+            count = 0
+        yield (x, y, None)
+    if count:
+        yield span(start, end, count)
+
 class GroupingFilter(RepoFilter, StatStream):
     """
     Combines changesets from `RepoStream` in groups by dates.
     """
-    def __init__(self, repo, resolution=7, relax_days=7):
+    def __init__(self, repo, resolution=7, relax_days=7, till_now=True, spans=False,
+                 align=False):
         """
         Constructs a new `GroupedStream` instance which groups
         `CtxStatItem` objects from `repo` by equal timespans, as
@@ -277,72 +1063,578 @@ class GroupingFilter(RepoFilter, StatStream):
 
         Note that contexts are preserved only for the latest items of
         each group.
+
+        Frames are produced until current date if `till_now` is True.
+        Otherwise, stream ends with the first empty frame after the
+        last input item, which saves a lot of zero items for
+        repositories not active anymore.
+
+        If `spans` is True, runs of consecutive empty frames are
+        represented by single `SpanStatItem` objects.
+
+        If `align` is True, frames are counted from Epoch (in local
+        time) rather than from the first changeset, and the last frame
+        ends after current date instead of being cut at it. Frames of
+        all repositories line up then, so that their results may be
+        summed (see `MergeStream`).
+
+        If ``open_end`` attribute is set to True, only frames which
+        may not be changed by subsequent revisions are produced:
+        grouping stops at the frame where input ends instead of
+        going on until current date.
         """
         RepoFilter.__init__(self, repo)
         self.resolution = resolution
         self.relax_days = relax_days
+        self.till_now = till_now
+        self.spans = spans
+        self.align = align
+        self.open_end = False
+        self.state = self.grouper = None
+
+    @classmethod
+    def depends_on_time(cls, resolution=7, relax_days=7, till_now=True, *args):
+        # The last frames reach current date
+        return till_now
+
+    @classmethod
+    def estimate(cls, count, index, resolution=7, relax_days=7, *args):
+        if not count or not len(index):
+            return 0
+        return int((time.time() - index.date[0]) / 86400 / resolution) + 1
+
+    def _frames(self, pairs):
+        """
+        Yield ``(x, y, x_end)`` tuples for frames, where ``x_end`` is
+        None unless the frame is a span of empty ones.
+        """
+        self.grouper = FrameGrouper(self.resolution, self.relax_days,
+                                    state=self.state, align=self.align)
+        if self.open_end:
+            frames = self.grouper.feed(pairs)
+        else:
+            frames = self.grouper.group(pairs, self.till_now)
+        if self.spans:
+            return zero_spans(frames)
+        return ((x, y, None) for (x, y) in frames)
 
     def __iter__(self):
-        def not_too_old(up_to, delta):
-            """Make *filter* which will return True only for contexts
-            which are no earlier than `up_to-delta`"""
-            def test(ctx):
-                return ctx.datetime > (up_to - delta)
-            return test
-
-        def snap_date(date):
-            """Snap to beginning of day."""
-            return datetime.datetime(*date.timetuple()[:3]) # It's a lion!
-
-        data = iter(self.stream)
-
-        # We assume that data contains at least one item
-        item = data.next()
-
-        cur_date = snap_date(item.datetime)
-        datemax = datetime.datetime.now()
-        delta = datetime.timedelta(self.resolution)
-        relax_period = datetime.timedelta(self.relax_days)
-
-        group = []
-        while cur_date <= datemax:
-            # Collect new items
-            while item.datetime < cur_date:
-                group.append(item)
-                try:
-                    item = data.next()
-                # No more items in the stream
-                except StopIteration:
-                    break
-            # Drop old items
-            group = filter(not_too_old(cur_date, relax_period), group)
-
-            # Upcoming chunk occured, flushing collected group
-            yield StatItem(x=int(cur_date.strftime('%s')), \
-                           y=sum(map(lambda i: i.y, group)))
-            cur_date += delta
-            # Snap to datemax to prevent skipping items from the last
-            # group
-            if cur_date > datemax and cur_date < datemax + delta:
-                cur_date = datemax
-            
+        pairs = ((item.x, item.y) for item in self.stream)
+        for (x, y, x_end) in self._frames(pairs):
+            if x_end is None:
+                yield StatItem(x=x, y=y)
+            else:
+                yield SpanStatItem(x=x, y=y, x_end=x_end)
+
+    def columns(self):
+        cols = self.stream.columns()
+        x, y = array('l'), array(cols.y.typecode)
+        for (frame_x, frame_y, x_end) in self._frames(zip(cols.x, cols.y)):
+            x.append(frame_x)
+            y.append(frame_y)
+            # Spans are stored as their ends
+            if x_end is not None:
+                x.append(x_end)
+                y.append(frame_y)
+        return Columns(x, y, array('l', [-1]) * len(x))
+
+    def get_state(self):
+        return self.grouper and self.grouper.get_state() or self.state
+
+    def set_state(self, state):
+        self.state = state
 
 class TagsFilter(RepoFilter, RepoStream):
     """
     Filters out non-tagged changesets.
 
     ``tip`` tag is not included.
+
+    When applied right to `RepoStream`, only items for tagged
+    revisions are made, so the work done depends on the number of
+    tags only.
     """
+    reads_source = True
+
+    def _tagged_revs(self, source):
+        """
+        Return sorted list of tagged revisions in range of `source`
+        `RepoStream`.
+        """
+        revs = self.get_index().tagged_revs()
+        return revs[bisect_left(revs, source.from_rev):
+                    bisect_right(revs, source.to_rev)]
+
+    def get_state(self):
+        # Tags may be added to already processed changesets later, so
+        # remember which ones were tagged
+        to_rev = self.get_source().to_rev
+        return (to_rev, [rev for rev in self.get_index().tagged_revs()
+                         if rev <= to_rev])
+
+    def set_state(self, state):
+        to_rev, revs = state
+        if not [rev for rev in self.get_index().tagged_revs()
+                if rev <= to_rev] == revs:
+            raise StaleState('Tags of processed changesets have changed')
+
+    @classmethod
+    def estimate(cls, count, index, *args):
+        return min(count, len(index.tags))
+
+    @classmethod
+    def can_fuse(cls, *args, **kwargs):
+        return True
+
+    def mapper(self):
+        tags = self.get_index().tags
+        return lambda item: item.rev in tags and item or None
+
     def __iter__(self):
-        for item in self.stream:
-            if item.ctx.tags() and not item.ctx.tags() == ['tip']:
-                yield item
+        source = self.direct_source()
+        if source:
+            return source.rev_items(self._tagged_revs(source))
+        return self._mapped()
+
+    def columns(self):
+        source = self.direct_source()
+        if source:
+            return source.rev_columns(self._tagged_revs(source))
+        cols = self.stream.columns()
+        tags = self.get_index().tags
+        return cols.take([i for i in xrange(len(cols)) if cols.rev[i] in tags])
+
+class DateFilter(RepoFilter, RepoStream):
+    """
+    Keeps only changesets made from `days` days ago till `until_days`
+    days ago.
+
+    When applied right to `RepoStream`, range of revisions to be
+    looked at is found by bisecting date bounds from repository index
+    (see `cache.RepoIndex`), so that only changesets in that range
+    are touched.
+    """
+    reads_source = True
+    # Results depend on current time
+    resumable = False
+
+    def __init__(self, repo, days, until_days=0):
+        RepoFilter.__init__(self, repo)
+        now = time.time()
+        self.start = now - days * 86400
+        self.end = now - until_days * 86400
+
+    @classmethod
+    def depends_on_time(cls, *args):
+        return True
+
+    @classmethod
+    def estimate(cls, count, index, days=0, until_days=0, *args):
+        now = time.time()
+        first, last = index.date_revs(now - days * 86400, now - until_days * 86400)
+        return max(min(count, last - first + 1), 0)
+
+    @classmethod
+    def can_fuse(cls, *args, **kwargs):
+        return True
+
+    def _window_revs(self, source):
+        """
+        Return list of revisions in range of `source` `RepoStream`
+        with dates in filter window.
+        """
+        index = self.get_index()
+        date = index.date
+        first, last = index.date_revs(self.start, self.end)
+        return [rev for rev in xrange(max(first, source.from_rev),
+                                      min(last, source.to_rev) + 1)
+                if self.start <= date[rev] <= self.end]
+
+    def mapper(self):
+        start, end = self.start, self.end
+        return lambda item: start <= item.x <= end and item or None
+
+    def __iter__(self):
+        source = self.direct_source()
+        if source:
+            return source.rev_items(self._window_revs(source))
+        return self._mapped()
+
+    def columns(self):
+        source = self.direct_source()
+        if source:
+            return source.rev_columns(self._window_revs(source))
+        cols = self.stream.columns()
+        start, end, x = self.start, self.end, cols.x
+        return cols.take([i for i in xrange(len(cols)) if start <= x[i] <= end])
+
+def read_aliases(file_name):
+    """
+    Return dictionary of author aliases from file `file_name`, which
+    has lines of form ``alias = name`` (like churn extension uses).
+
+    Raise `BadAliases` with file name and line number if a line is
+    malformed.
+    """
+    aliases = {}
+    for (number, line) in enumerate(open(file_name)):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '=' in line:
+            alias, name = line.rsplit('=', 1)
+        elif len(line.split()) > 1:
+            alias, name = line.rsplit(None, 1)
+        else:
+            alias = name = ''
+        if not (alias.strip() and name.strip()):
+            raise BadAliases('%s:%d: malformed alias line: %s'
+                             % (file_name, number + 1, line))
+        aliases[alias.strip()] = name.strip()
+    return aliases
+
+class AuthorFilter(RepoFilter, SeriesStream):
+    """
+    Sums ``y`` values of changesets by authors and time frames, making
+    a series for every author.
+    """
+    options = ['aliases']
+    # Output series are ordered by their totals
+    resumable = False
+
+    def __init__(self, repo, resolution=7, emails=False, aliases=None):
+        """
+        Construct a new `AuthorFilter` instance which groups items of
+        `repo` by authors and `resolution` days frames. Frames are
+        counted from Epoch, so that frames of all authors are
+        aligned. Output ``x`` is the beginning of frame (in Epoch
+        seconds), ``y`` is the sum of ``y`` of all changesets made by
+        author during frame. Frames without changesets are skipped.
+
+        Applied to `RepoStream`, this gives commit counts of authors,
+        while after `DiffstatFilter` it gives their churn.
+
+        If `emails` is True, authors are told apart by their lowercase
+        e-mail addresses only. Authors (or e-mails) are then replaced
+        with names given in `aliases` file (see `read_aliases`);
+        ``.hgchurn`` in repository root is read, if present, when
+        it's not given.
+
+        Series of most active authors come first. All changesets are
+        summed in a single pass using a dictionary with a key per
+        author and frame, so the work done does not depend on the
+        number of authors.
+        """
+        RepoFilter.__init__(self, repo)
+        self.resolution = resolution
+        self.emails = emails
+        self.aliases = aliases
+
+    @classmethod
+    def estimate(cls, count, index, resolution=7, *args):
+        if not count or not len(index):
+            return 0
+        frames = int((time.time() - index.date[0]) / 86400 / resolution) + 1
+        return min(count, frames * len(index.authors))
+
+    def _labels(self, index):
+        """
+        Return list of series labels for authors from `index`.
+        """
+        aliases = {}
+        file_name = self.aliases or \
+                    os.path.join(self.stream.get_repo().root, '.hgchurn')
+        if self.aliases or os.path.isfile(file_name):
+            aliases = read_aliases(file_name)
+        labels = []
+        for author in index.authors:
+            if self.emails:
+                author = util.email(author).lower()
+            labels.append(aliases.get(author, author))
+        return labels
+
+    def _series(self, rows):
+        """
+        Sum ``(rev, x, y)`` tuples from `rows` by authors and frames,
+        return a list of ``(label, frames)`` tuples, where frames is a
+        sorted list of ``(x, y)`` tuples.
+        """
+        index = self.stream.get_index()
+        labels, author = self._labels(index), index.author
+        period = self.resolution * 86400
+        sums = {}
+        for (rev, x, y) in rows:
+            key = (labels[author[rev]], int(x // period))
+            sums[key] = sums.get(key, 0) + y
+        series, totals = {}, {}
+        for ((label, frame), y) in sums.iteritems():
+            series.setdefault(label, []).append((frame * period, y))
+            totals[label] = totals.get(label, 0) + y
+        order = sorted(series, key=lambda label: (-totals[label], label))
+        return [(label, sorted(series[label])) for label in order]
+
+    def __iter__(self):
+        rows = ((item.rev, item.x, item.y) for item in self.stream)
+        return series_items(self._series(rows))
+
+    def columns(self):
+        cols = self.stream.columns()
+        return series_columns(self._series(izip(cols.rev, cols.x, cols.y)))
+
+def iter_lines(chunks):
+    """
+    Yield lines from a sequence of text `chunks`, as if they were
+    joined and split by newlines, without building the joined
+    string.
+
+    >>> list(iter_lines(['a\\nb', 'c\\n', '\\nd']))
+    ['a', 'bc', '', 'd']
+    """
+    tail = ''
+    for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find('\n', start)
+            if end < 0:
+                break
+            yield tail + chunk[start:end]
+            tail = ''
+            start = end + 1
+        tail += chunk[start:]
+    yield tail
+
+_diff_re = re.compile('^diff .*-r [a-z0-9]+\s(.*)$')
+
+def diffstat_stream(lines):
+    """
+    Incrementally compute diffstat of patch `lines`, yielding tuples
+    with file name, lines added, lines removed and binary flag for
+    every file in the patch.
+
+    Results are the same as those of `mercurial.patch.diffstatdata`,
+    but only one line has to be kept in memory at a time:
+
+    >>> from mercurial import hg, ui
+    >>> repo = hg.repository(ui.ui(), '/home/sphinx/projects/hgstats')
+    >>> def both(ctx):
+    ...     chunks = list(patch.diff(repo, ctx.p1().node(), ctx.node()))
+    ...     return (list(diffstat_stream(iter_lines(chunks))),
+    ...             patch.diffstatdata(''.join(chunks).split('\\n')))
+    >>> [rev for rev in repo if cmp(*both(repo[rev]))]
+    []
+    """
+    filename, adds, removes, isbinary = None, 0, 0, False
+    # Lines starting with '--' or '++' in file headers are not
+    # counted
+    inheader = False
+    for line in lines:
+        if line.startswith('diff'):
+            if filename:
+                yield (filename, adds, removes, isbinary)
+            inheader = True
+            adds, removes, isbinary = 0, 0, False
+            if line.startswith('diff --git a/'):
+                filename = patch.gitre.search(line).group(2)
+            elif line.startswith('diff -r'):
+                filename = _diff_re.search(line).group(1)
+        elif line.startswith('@@'):
+            inheader = False
+        elif line.startswith('+') and not inheader:
+            adds += 1
+        elif line.startswith('-') and not inheader:
+            removes += 1
+        elif (line.startswith('GIT binary patch') or
+              line.startswith('Binary file')):
+            isbinary = True
+    if filename:
+        yield (filename, adds, removes, isbinary)
+
+def ctx_diffstat(repo, node1, node2):
+    """
+    Return a tuple with numbers of lines added, lines removed and files
+    touched between `node1` and `node2` changesets of `repo`.
+
+    Patch text is never held in memory as a whole.
+    """
+    added, removed, files = 0, 0, 0
+    for (filename, adds, removes, isbinary) in \
+            diffstat_stream(iter_lines(patch.diff(repo, node1, node2))):
+        added += adds
+        removed += removes
+        files += 1
+    return (added, removed, files)
+
+def ctx_file_diffstat(repo, node1, node2, include=(), exclude=()):
+    """
+    Return a tuple of ``(file, added, removed)`` tuples for every file
+    changed between `node1` and `node2` changesets of `repo`.
+
+    Only files matching `include` and not matching `exclude` glob
+    patterns (like those of ``hg diff -I -X``) are diffed, if they are
+    given.
+    """
+    matcher = None
+    if include or exclude:
+        matcher = match.match(repo.root, '', [], include=list(include),
+                              exclude=list(exclude))
+    return tuple([(filename, adds, removes)
+                  for (filename, adds, removes, isbinary) in
+                  diffstat_stream(iter_lines(patch.diff(repo, node1, node2,
+                                                        match=matcher)))])
+
+# Repositories opened by worker processes, by root
+_worker_repos = {}
+
+# Pools of worker processes, by number of workers
+_pools = {}
+
+def _shared_pool(workers):
+    """
+    Return pool of `workers` processes shared by all `Differ`
+    instances, so that pipelines evaluated at the same time (like
+    merged ones, see `MergeStream`) do not start a pool each.
+    """
+    if workers not in _pools:
+        _pools[workers] = multiprocessing.Pool(workers)
+    return _pools[workers]
+
+def _diffstat_chunk(args):
+    """
+    Worker function for parallel `Differ`.
+
+    `args` is a tuple with repository root, diffstat function, its
+    extra arguments and a list of node pairs. Return a list of
+    function results for all pairs.
+    """
+    root, function, extra, pairs = args
+    if root not in _worker_repos:
+        _worker_repos[root] = hg.repository(ui.ui(), root)
+    repo = _worker_repos[root]
+    return [function(repo, node1, node2, *extra) for (node1, node2) in pairs]
+
+def _batches(iterable, size):
+    """
+    Split `iterable` into lists of at most `size` items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Differ():
+    """
+    Computes diffstats of changesets for filters, keeping them in a
+    persistent cache and possibly using worker processes.
+    """
+    # Number of changesets sent to worker process at once
+    chunk_size = 32
+
+    def __init__(self, repo, function, extra=(), cache=None, workers=1):
+        """
+        Diffstats are results of `function` called with `repo`, two
+        nodes and `extra` arguments (like `ctx_diffstat`), stored in
+        `cache` (like `cache.DiffstatCache`) by the second node if
+        it's given.
+
+        If `workers` is greater than 1, changesets are diffed in a
+        pool of that many worker processes, shared by all instances.
+        `function` must be a module-level one then.
+        """
+        self.repo = repo
+        self.function = function
+        self.extra = tuple(extra)
+        self.cache = cache
+        self.workers = workers
+
+    def get(self, node1, node2):
+        """
+        Return diffstat of `node2` against `node1`.
+        """
+        cache = self.cache
+        stats = cache and cache.get(node2)
+        if stats is None:
+            stats = self.function(self.repo, node1, node2, *self.extra)
+            if cache:
+                cache.set(node2, stats)
+        return stats
+
+    def _serial_stats(self, pairs):
+        for (payload, node1, node2) in pairs:
+            yield payload, self.get(node1, node2)
+
+    def _parallel_stats(self, pairs):
+        """
+        Diff node pairs in a pool of worker processes.
+
+        Pairs are processed in batches. While results for one batch
+        are being yielded, the next one is already being diffed.
+        """
+        cache = self.cache
+        def submit(batch):
+            todo = []
+            for (payload, node1, node2) in batch:
+                # Stats may be empty for some diffstat functions
+                if not cache or cache.get(node2) is None:
+                    todo.append((node1, node2))
+            chunks = [(root, self.function, self.extra, todo[i:i + self.chunk_size])
+                      for i in xrange(0, len(todo), self.chunk_size)]
+            return batch, pool.map_async(_diffstat_chunk, chunks)
+
+        def collect(submitted):
+            batch, result = submitted
+            computed = iter([stats for chunk in result.get() for stats in chunk])
+            for (payload, node1, node2) in batch:
+                stats = cache and cache.get(node2)
+                if stats is None:
+                    stats = computed.next()
+                    if cache:
+                        cache.set(node2, stats)
+                yield payload, stats
+
+        root = self.repo.root
+        pool = _shared_pool(self.workers)
+        pending = None
+        for batch in _batches(pairs, self.chunk_size * self.workers * 2):
+            submitted = submit(batch)
+            if pending:
+                for res in collect(pending):
+                    yield res
+            pending = submitted
+        if pending:
+            for res in collect(pending):
+                yield res
+
+    def stats(self, pairs):
+        """
+        Yield tuples with payload and diffstat for ``(payload, node1,
+        node2)`` tuples from `pairs`, in the same order. Cache is saved
+        when all pairs are done.
+        """
+        if self.workers > 1:
+            stats_stream = self._parallel_stats(pairs)
+        else:
+            stats_stream = self._serial_stats(pairs)
+        try:
+            for res in stats_stream:
+                yield res
+        finally:
+            self.save()
+
+    def save(self):
+        if self.cache:
+            self.cache.save()
 
 class DiffstatFilter(RepoFilter, RepoStream):
     """
     Sets diffstat results as ``y`` values.
     """
-    def __init__(self, stream, show_delta=False):
+    options = ['workers']
+
+    def __init__(self, stream, show_delta=False, use_cache=True, workers=None):
         """
         Construct new `DiffstatFilter` instance for `stream`.
 
@@ -360,34 +1652,512 @@ class DiffstatFilter(RepoFilter, RepoStream):
         If `AccFilter` is applied after this one when `show_delta` is
         True, a stream of total repository sizes (in lines) will be
         produced.
+
+        If `use_cache` is True, diffstat results are stored in
+        persistent `cache.DiffstatCache` so that only changesets not
+        seen before are diffed on subsequent runs.
+
+        If `workers` is greater than 1, changesets are diffed in that
+        many worker processes. Items are produced in the same order
+        as with a single process.
         """
         RepoFilter.__init__(self, stream)
         if show_delta:
-            self.delta_function = lambda t: t[1] - t[2]
+            self.delta_function = lambda t: t[0] - t[1]
         else:
-            self.delta_function = lambda t: t[1] + t[2]
+            self.delta_function = lambda t: t[0] + t[1]
         self.show_delta = show_delta
+        self.use_cache = use_cache
+        self.workers = workers or 1
+        self.differ = None
+
+    # Diffing is by far the most expensive operation
+    cost = 100
+
+    @classmethod
+    def estimate(cls, count, index, *args):
+        # Merges are skipped
+        merges = len(index) - list(index.p2).count(-1)
+        return count * (len(index) - merges) / max(len(index), 1)
+
+    def _differ(self):
+        repo = self.get_repo()
+        cache = self.use_cache and DiffstatCache.shared(repo) or None
+        return Differ(repo, ctx_diffstat, (), cache, self.workers)
+
+    @classmethod
+    def can_fuse(cls, show_delta=False, use_cache=True, workers=None):
+        # Parallel mode needs to see many items at once
+        return not (workers or 1) > 1
+
+    def fusable(self):
+        return self.can_fuse(workers=self.workers)
+
+    def mapper(self):
+        if not self.fusable():
+            return None
+        index = self.get_index()
+        node = index.node
+        differ = self.differ = self._differ()
+        def diffstat(item):
+            rev = item.rev
+            # Skip merges
+            if not index.p2[rev] == -1:
+                return None
+            stats = differ.get(node(index.p1[rev]), node(rev))
+            return item.child(x=index.date[rev], y=self.delta_function(stats))
+        return diffstat
+
+    def finish(self):
+        if self.differ:
+            self.differ.save()
+            self.differ = None
 
     def __iter__(self):
-        for item in self.stream:
-            ctx = item.ctx
-            if len(ctx.parents()) < 2:
-                p = ''.join(patch.diff(ctx._repo, ctx.p1().node(), ctx.node()))
-                lines = p.split('\n')
-                stats = sum(map(self.delta_function, patch.diffstatdata(lines)))
-                yield item.child(x=ctx.date()[0], y=stats)
+        if not self.workers > 1:
+            return self._mapped()
+        return self._parallel_iter()
+
+    def _parallel_iter(self):
+        index = self.get_index()
+        node = index.node
+        # Skip merges
+        pairs = ((item, node(index.p1[item.rev]), node(item.rev))
+                 for item in self.stream if index.p2[item.rev] == -1)
+        for item, stats in self._differ().stats(pairs):
+            yield item.child(x=index.date[item.rev], y=self.delta_function(stats))
+
+    def columns(self):
+        cols = self.stream.columns()
+        index = self.get_index()
+        node = index.node
+        def pairs():
+            for i in xrange(len(cols)):
+                rev = cols.rev[i]
+                # Skip merges
+                if index.p2[rev] == -1:
+                    yield i, node(index.p1[rev]), node(rev)
+        indices, y = array('l'), array('l')
+        for i, stats in self._differ().stats(pairs()):
+            indices.append(i)
+            y.append(self.delta_function(stats))
+        res = cols.take(indices)
+        res.y = y
+        return res
+
+class PathNode(object):
+    """
+    Directory in `PathTrie`.
+
+    ``total`` is the churn of all files in directory and its
+    subdirectories, ``last`` is the date of the latest change among
+    them. ``frames`` maps time frames to churn of files counted in
+    this directory itself, if frames are collected.
+    """
+    # Tries of large repositories have many nodes
+    __slots__ = ['path', 'children', 'total', 'last', 'frames']
+
+    def __init__(self, path):
+        self.path = path
+        self.children = {}
+        self.total = 0
+        self.last = None
+        self.frames = None
+
+    def add(self, value, date):
+        self.total += value
+        if self.last is None or date > self.last:
+            self.last = date
+
+class PathTrie():
+    """
+    Directory prefix tree which adds churn of every changed file to
+    all of its parent directories, as files are fed one by one.
+
+    >>> trie = PathTrie(depth=2)
+    >>> for path in ['a/b/c/x.py', 'a/b/y.py', 'a/z.py', 'README']:
+    ...     trie.add(path, 10, 0)
+    >>> [(node.path, node.total) for node in trie.hottest(3)]
+    [('a', 30), ('a/b', 20)]
+    >>> trie.root.total
+    40
+
+    Directories deeper than `depth` levels are not stored, their files
+    are counted in ancestors at `depth` level instead. Memory used
+    grows with the number of distinct directories only, no matter how
+    many changesets are fed.
+    """
+    def __init__(self, depth=None):
+        self.depth = depth
+        self.root = PathNode('')
+
+    def add(self, path, value, date, frame=None):
+        """
+        Add churn `value` of file `path` changed at `date`.
+
+        If `frame` is given, `value` is also summed by frames in the
+        directory where the file is counted (the deepest one stored).
+        """
+        node = self.root
+        node.add(value, date)
+        dirs = path.split('/')[:-1]
+        if self.depth:
+            dirs = dirs[:self.depth]
+        for name in dirs:
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = \
+                        PathNode(node.path and '%s/%s' % (node.path, name) or name)
+            node = child
+            node.add(value, date)
+        if frame is not None:
+            if node.frames is None:
+                node.frames = {}
+            node.frames[frame] = node.frames.get(frame, 0) + value
+
+    def nodes(self):
+        """
+        Yield all nodes of the trie, parents first.
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.itervalues())
+
+    def hottest(self, n):
+        """
+        Return a list of at most `n` directories with the greatest
+        churn, greatest first.
+        """
+        return heapq.nsmallest(n, (node for node in self.nodes() if node.path),
+                               key=lambda node: (-node.total, node.path))
+
+class PathFilter(RepoFilter, SeriesStream):
+    """
+    Base class for filters which gather churn (lines added plus lines
+    removed) of every file changed by changesets in a `PathTrie`.
+
+    Merge changesets are not included.
+    """
+    options = ['include', 'exclude', 'workers']
+    cost = 100
+    resumable = False
+
+    def __init__(self, repo, series, depth=None, resolution=None, include=(),
+                 exclude=(), workers=None):
+        """
+        `series` is a function returning a list of ``(label, points)``
+        tuples (see `series_items`) for the filled `PathTrie`; it tells
+        which series are made of the trie, the rest of filter is
+        common.
+
+        Directories deeper than `depth` levels are not told apart (see
+        `PathTrie`), if it's given. If `resolution` is given, churn
+        is also summed over `resolution` days frames counted from
+        Epoch.
+
+        `include` and `exclude` are lists of glob patterns of file
+        paths to be included and excluded (like those of ``hg diff -I
+        -X``); other files are not diffed at all.
+
+        Diffstats of files are kept in persistent
+        `cache.FileDiffstatCache`, and changesets are diffed in
+        `workers` processes (see `DiffstatFilter`).
+
+        The trie is kept under ``trie`` attribute after stream is
+        evaluated.
+        """
+        RepoFilter.__init__(self, repo)
+        self.series = series
+        self.depth = depth
+        self.resolution = resolution
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.workers = workers or 1
+        self.trie = None
+
+    def _fill(self, rows):
+        """
+        Return `PathTrie` with churn of changesets from ``(rev, x)``
+        tuples in `rows`.
+        """
+        repo, index = self.stream.get_repo(), self.stream.get_index()
+        node = index.node
+        cache = FileDiffstatCache.shared(repo, self.include, self.exclude)
+        differ = Differ(repo, ctx_file_diffstat, (self.include, self.exclude),
+                        cache, self.workers)
+        pairs = ((x, node(index.p1[rev]), node(rev))
+                 for (rev, x) in rows if index.p2[rev] == -1)
+        period = self.resolution and self.resolution * 86400
+        trie = self.trie = PathTrie(self.depth)
+        for (x, files) in differ.stats(pairs):
+            frame = None
+            if period:
+                frame = int(x // period) * period
+            for (filename, adds, removes) in files:
+                trie.add(filename, adds + removes, x, frame)
+        return trie
+
+    def __iter__(self):
+        rows = ((item.rev, item.x) for item in self.stream)
+        return series_items(self.series(self._fill(rows)))
+
+    def columns(self):
+        cols = self.stream.columns()
+        return series_columns(self.series(self._fill(izip(cols.rev, cols.x))))
+
+def _path_label(path):
+    return path or '.'
+
+class PathChurnFilter(PathFilter):
+    """
+    Sums churn of files by directories and time frames, making a
+    series for every directory.
+    """
+    def __init__(self, repo, depth=1, resolution=7, include=(), exclude=(),
+                 workers=None):
+        """
+        Construct a new `PathChurnFilter` instance which sums churn of
+        files changed by `repo` changesets over `resolution` days
+        frames (counted from Epoch), for every directory `depth`
+        levels deep. Files in subdirectories are counted in their
+        ancestor at that level, while files up the tree are counted in
+        their own directories (``.`` stands for repository root).
+
+        ``x`` of items is the beginning of frame (in Epoch seconds),
+        ``y`` is the churn of directory during frame. Frames without
+        changes are skipped.
+
+        With default `depth`, this gives churn of every top-level
+        component of repository over time. Series of directories
+        changed most come first.
+        """
+        PathFilter.__init__(self, repo, self._series, depth, resolution,
+                            include, exclude, workers)
+
+    def _series(self, trie):
+        series = [(_path_label(node.path), sorted(node.frames.iteritems()))
+                  for node in trie.nodes() if node.frames]
+        series.sort(key=lambda (label, points):
+                    (-sum([y for (x, y) in points]), label))
+        return series
+
+class HotPathsFilter(PathFilter):
+    """
+    Finds directories with the greatest churn.
+    """
+    def __init__(self, repo, n=10, depth=0, include=(), exclude=(), workers=None):
+        """
+        Construct a new `HotPathsFilter` instance which finds `n`
+        directories (at any level, or at most `depth` levels deep if
+        it's not 0) with the greatest churn of files changed by
+        `repo` changesets.
+
+        A series with a single item is made for every directory,
+        hottest first: ``x`` is the date of its latest change, ``y``
+        is its churn.
+        """
+        PathFilter.__init__(self, repo, self._series, depth or None, None,
+                            include, exclude, workers)
+        self.n = n
+
+    @classmethod
+    def estimate(cls, count, index, n=10, *args):
+        return min(count, n)
+
+    def _series(self, trie):
+        return [(_path_label(node.path), [(node.last, node.total)])
+                for node in trie.hottest(self.n)]
+
+def lttb(x, y, threshold):
+    """
+    Return sorted list of indices of at most `threshold` points to be
+    kept from ``(x, y)`` points given by `x` and `y` sequences, so that
+    the plot keeps its visual shape.
+
+    Largest-Triangle-Three-Buckets algorithm is used: first and last
+    points are always kept, all others are split into ``threshold - 2``
+    buckets and from every bucket the point forming the largest
+    triangle with the previously kept point and the average point of
+    the next bucket is chosen. Every point is looked at twice, so it
+    runs in linear time.
+
+    >>> lttb(range(10), [0, 1, 0, 5, 0, 1, 0, 1, 9, 0], 5)
+    [0, 2, 3, 8, 9]
+    >>> lttb([1, 2, 3], [3, 2, 1], 10)
+    [0, 1, 2]
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return range(count)
+    buckets = threshold - 2
+    def bound(k):
+        # Next bucket for the last one is the last point
+        return min(1 + k * (count - 2) // buckets, count)
+
+    kept = [0]
+    prev = 0
+    for k in xrange(buckets):
+        start, end, next_end = bound(k), bound(k + 1), bound(k + 2)
+        avg_x = float(sum(x[end:next_end])) / (next_end - end)
+        avg_y = float(sum(y[end:next_end])) / (next_end - end)
+        prev_x, prev_y = x[prev], y[prev]
+        best, best_area = start, -1
+        for i in xrange(start, end):
+            # Doubled triangle area is good for comparisons
+            area = abs((prev_x - avg_x) * (y[i] - prev_y) -
+                       (prev_x - x[i]) * (avg_y - prev_y))
+            if area > best_area:
+                best, best_area = i, area
+        kept.append(best)
+        prev = best
+    kept.append(count - 1)
+    return kept
+
+class DownsampleFilter(StreamFilter, StatStream):
+    """
+    Keeps at most `threshold` items of stream, preserving visual shape
+    of its plot (see `lttb`).
+
+    As all items are needed to choose which of them are kept, results
+    can't be continued with new revisions, and pipespecs with this
+    filter are evaluated fully in incremental mode.
+    """
+    resumable = False
+
+    def __init__(self, stream, threshold=600):
+        StreamFilter.__init__(self, stream)
+        self.threshold = threshold
+
+    @classmethod
+    def estimate(cls, count, index, threshold=600, *args):
+        if threshold < 3:
+            return count
+        return min(count, threshold)
+
+    def __iter__(self):
+        items = list(self.stream)
+        kept = lttb([item.x for item in items], [item.y for item in items],
+                    self.threshold)
+        for i in kept:
+            yield items[i]
+
+    def columns(self):
+        cols = self.stream.columns()
+        return cols.take(lttb(cols.x, cols.y, self.threshold))
+
+def _ordered(values):
+    for i in xrange(1, len(values)):
+        if values[i] < values[i - 1]:
+            return False
+    return True
+
+def _nearest(target_x, k, value, tolerance):
+    """
+    Return index of `target_x` value nearest to `value` at most
+    `tolerance` away (the lesser one, if there are two), or None.
+    `k` is the index of the first target value not less than `value`.
+    """
+    best = None
+    for j in (k - 1, k):
+        if 0 <= j < len(target_x) and abs(target_x[j] - value) <= tolerance and \
+           (best is None or abs(target_x[j] - value) < abs(target_x[best] - value)):
+            best = j
+    return best
+
+class _JoinIndex():
+    """
+    Index of target values for matching values which come in any
+    order, see `join_columns`.
+    """
+    def __init__(self, target_x, target_y, tolerance=0):
+        self.tolerance = tolerance
+        if not tolerance:
+            # Exact matches are looked up in a hash table
+            self.first = {}
+            for j in xrange(len(target_x) - 1, -1, -1):
+                self.first[target_x[j]] = target_y[j]
+            return
+        # Nearest ones are found by bisecting sorted values
+        if not _ordered(target_x):
+            order = sorted(xrange(len(target_x)), key=target_x.__getitem__)
+            target_x = [target_x[j] for j in order]
+            target_y = [target_y[j] for j in order]
+        self.x, self.y = target_x, target_y
+
+    def get(self, value):
+        """
+        Return target ``y`` value matched with `value`, or None.
+        """
+        if not self.tolerance:
+            return self.first.get(value)
+        j = _nearest(self.x, bisect_left(self.x, value), value, self.tolerance)
+        if j is None:
+            return None
+        return self.y[j]
+
+def join_columns(x, target_x, target_y, tolerance=0):
+    """
+    Match values of `x` with those of `target_x`, return a tuple of
+    lists with indexes of matched `x` values and `target_y` values
+    at their matches.
+
+    With zero `tolerance`, values must be equal. Otherwise, the
+    nearest target value at most `tolerance` away is used (the lesser
+    one, if there are two). Values without matches are skipped:
+
+    >>> join_columns([1, 2, 4, 7], [1, 4, 5], [10, 40, 50])
+    ([0, 2], [10, 40])
+    >>> join_columns([1, 2, 4, 7], [1, 4, 5], [10, 40, 50], 1)
+    ([0, 1, 2], [10, 10, 40])
+    >>> join_columns([7, 4, 1, 2], [5, 4, 1], [50, 40, 10], 1)
+    ([1, 2, 3], [40, 10, 10])
+
+    When both `x` and `target_x` are sorted, they're merge-joined in
+    linear time. Otherwise, target values are indexed (see
+    `_JoinIndex`): exact matches are looked up in a hash table,
+    while nearest ones are found by bisecting sorted target values.
+    If target has several equal values, the first one is used.
+    """
+    indices, ys = [], []
+    if not (_ordered(x) and _ordered(target_x)):
+        index = _JoinIndex(target_x, target_y, tolerance)
+        for i in xrange(len(x)):
+            y = index.get(x[i])
+            if y is not None:
+                indices.append(i)
+                ys.append(y)
+        return indices, ys
+    k, m = 0, len(target_x)
+    for i in xrange(len(x)):
+        value = x[i]
+        while k < m and target_x[k] < value:
+            k += 1
+        j = _nearest(target_x, k, value, tolerance)
+        if j is not None:
+            indices.append(i)
+            ys.append(target_y[j])
+    return indices, ys
 
 class DropFilter(StreamFilter, StatStream):
     """
     Sets ``y`` values of items in one stream equal to those in another
     one.
+
+    In pipespecs, the other stream is given as the number of another
+    pipespec (counting from 1, see `pipespec.PlanSet`).
     """
-    def __init__(self, stream, target_stream):
+    joins = True
+    # Other stream is evaluated as a whole
+    resumable = False
+
+    def __init__(self, stream, target_stream, tolerance=0, exact=False):
         """
         Contruct a new `DropFilter` instance which will make ``y``
         attributes of `StatItem` objects in `stream` equal to those
         of items in `target_stream` which have the same ``x``
-        attribute value.
+        attribute value (or the nearest one at most `tolerance` away).
 
                                  o
                             *     
@@ -403,24 +2173,49 @@ class DropFilter(StreamFilter, StatStream):
         - o: `target_stream` items;
         - x: items produced by this filter.
 
-        We assume that if A precedes B in `stream`, then items with
-        the same ``x`` values in `target_stream` come in that order,
-        too.
+        Items with no match in `target_stream` are skipped, unless
+        `exact` is True: `UnsyncedStreams` is raised then. Streams may
+        come from different repositories. See `join_columns` for how
+        items are matched.
+
+        When iterated, only `target_stream` is evaluated as a whole
+        (column-wise) to be indexed, while items of `stream` are
+        matched one by one as they come.
         """
         StreamFilter.__init__(self, stream)
         self.target_stream = target_stream
+        self.tolerance = tolerance
+        self.exact = exact
+
+    def _unsynced(self, x):
+        return UnsyncedStreams('%s does not contain item with x=%s'
+                               % (self.target_stream, x))
 
     def __iter__(self):
-        target_data = iter(self.target_stream)
-        target_item = target_data.next()
+        target = self.target_stream.columns()
+        index = _JoinIndex(target.x, target.y, self.tolerance)
         for item in self.stream:
-            while not item.x == target_item.x:
-                try:
-                    target_item = target_data.next()
-                except StopIteration:
-                    raise UnsyncedStreams('%s does not contain item with x=%d'\
-                                          % (self.target_stream, item.x))
-            yield item.child(y = target_item.y)
+            y = index.get(item.x)
+            if y is not None:
+                yield item.child(y=y)
+            elif self.exact:
+                raise self._unsynced(item.x)
+
+    def columns(self):
+        cols = self.stream.columns()
+        target = self.target_stream.columns()
+        indices, ys = join_columns(cols.x, target.x, target.y, self.tolerance)
+        if self.exact and len(indices) < len(cols):
+            # Indices are ascending, find the first one skipped
+            missing = len(indices)
+            for (n, i) in enumerate(indices):
+                if not n == i:
+                    missing = n
+                    break
+            raise self._unsynced(cols.x[missing])
+        res = cols.take(indices)
+        res.y = array(target.y.typecode, ys)
+        return res
 
 if __name__ == "__main__":
     import doctest
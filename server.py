@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+"""
+Description
+===========
+
+Long-running HTTP server answering pipespec queries with JSON
+series::
+
+    ./server.py [-a ADDRESS] [-P PORT] [-j JOBS] PATH1 [PATH2 [..]]
+
+Requests:
+
+- ``GET /repos`` returns a list of served repository names;
+
+- ``GET /stats?repo=NAME&pipespec=PIPESPEC`` returns an object with
+  repository name, stream name, pipespec, revision range and ``x``
+  and ``y`` lists of values. For pipespecs making several series
+  (like ``AuthorFilter``), ``series`` gives a list of ``[label,
+  count]`` pairs, telling how many values belong to every series.
+
+Requests are handled in threads, while pipespecs are evaluated in a
+pool of `JOBS` worker processes. Worker processes open repositories
+once and keep their changeset indexes and diffstat caches in memory,
+reopening repositories only when their changelogs change. Results are
+memoized by repository root, tip node and pipespec, so repeated
+queries cost nothing until repository gets new changesets. At most
+`MEMO_SIZE` results are kept, least recently used ones are dropped
+first.
+
+Results of pipespecs which depend on current time (like those with
+``DateFilter`` or ``GroupingFilter`` producing frames till now) or
+have filters which may not be continued with new revisions are not
+memoized (see `pipespec.Plan.stable`), they are evaluated for every
+query.
+
+Author and licensing
+====================
+
+Copyright (C) 2009 Dmitry Dzhus <dima@sphinx.net.ru>
+
+This code is subject to GNU General Public License version 2, as can
+be read on <http://www.gnu.org/licenses/gpl-2.0.html>.
+"""
+
+import sys
+import json
+import getopt
+import threading
+import multiprocessing
+from collections import OrderedDict
+from urlparse import urlparse, parse_qs
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from mercurial import hg, ui
+from mercurial.i18n import _
+from mercurial.fancyopts import fancyopts
+
+from helpers import get_repo_name, changelog_stamp
+from pipespec import parse_pipespec, PlanSet, Error as PipespecError
+from processing import ColumnStream, IncompatibleFilter
+
+# Number of memoized results
+MEMO_SIZE = 64
+
+# Repositories opened by this process, by root
+_repos = {}
+
+def open_repo(root):
+    """
+    Return repository at `root`, opening it again if its changelog
+    has changed since it was opened.
+    """
+    stamp = changelog_stamp(root)
+    opened = _repos.get(root)
+    if opened is None or not opened[0] == stamp:
+        opened = _repos[root] = (stamp, hg.repository(ui.ui(), root))
+    return opened[1]
+
+def evaluate_query(root, pipespec):
+    """
+    Worker function: evaluate `pipespec` for repository at `root`,
+    return a tuple with stream name, its `processing.Columns` and
+    ``meta`` dictionary.
+    """
+    # Daemonic worker processes may not start their own pools
+    s = ColumnStream(parse_pipespec(pipespec, {'workers': 1})(open_repo(root)))
+    return str(s), s.columns(), s.meta
+
+class LRUMemo():
+    """
+    Dictionary keeping at most `size` recently used values.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, make):
+        """
+        Return value for `key`, calling `make` to get it if it's
+        missing.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                value = self.data.pop(key)
+            else:
+                value = make()
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+            return value
+        finally:
+            self.lock.release()
+
+    def forget(self, key):
+        self.lock.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self.lock.release()
+
+class SharedResult():
+    """
+    Wraps `multiprocessing.pool.AsyncResult`, which wakes only one of
+    the threads waiting for it, so that any number of threads may wait.
+    """
+    def __init__(self, async_res):
+        self.async_res = async_res
+        self.lock = threading.Lock()
+
+    def get(self):
+        self.lock.acquire()
+        try:
+            return self.async_res.get()
+        finally:
+            self.lock.release()
+
+class StatsServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves statistics for repositories at `paths`.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, paths, jobs, memo_size=MEMO_SIZE):
+        HTTPServer.__init__(self, address, StatsHandler)
+        self.roots = {}
+        for path in paths:
+            repo = open_repo(path)
+            self.roots[get_repo_name(repo)] = repo.root
+        self.pool = multiprocessing.Pool(jobs)
+        self.memo = LRUMemo(memo_size)
+
+    def query(self, name, pipespec):
+        """
+        Return result of `evaluate_query` for repository named `name`.
+
+        Pending evaluations are memoized as well, so that concurrent
+        equal queries are evaluated once. Results of plans which are
+        not stable are never memoized.
+        """
+        root = self.roots[name]
+        key = (root, open_repo(root).changelog.tip(), pipespec)
+        def evaluate():
+            return SharedResult(self.pool.apply_async(evaluate_query,
+                                                      (root, pipespec)))
+        if not parse_pipespec(pipespec).stable():
+            return evaluate().get()
+        pending = self.memo.get(key, evaluate)
+        try:
+            return pending.get()
+        except:
+            self.memo.forget(key)
+            raise
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.terminate()
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = dict((k, v[-1]) for (k, v) in parse_qs(url.query).items())
+        if url.path == '/repos':
+            self.send_json(200, sorted(self.server.roots))
+        elif url.path == '/stats':
+            self.send_stats(args.get('repo'), args.get('pipespec', ''))
+        else:
+            self.send_json(404, {'error': 'Unknown request %s' % url.path})
+
+    def send_stats(self, name, pipespec):
+        if name not in self.server.roots:
+            self.send_json(404, {'error': 'Unknown repository %s' % name})
+            return
+        # Check pipespec before bothering workers
+        try:
+            PlanSet([parse_pipespec(pipespec)])
+        except (PipespecError, IncompatibleFilter), err:
+            self.send_json(400, {'error': 'Bad pipespec: %s' % err})
+            return
+        try:
+            stream_name, columns, meta = self.server.query(name, pipespec)
+        except Exception, err:
+            self.send_json(500, {'error': 'Failed to process %s: %s' % (name, err)})
+            return
+        res = {'repo': name, 'name': stream_name,
+               'x': columns.x.tolist(), 'y': columns.y.tolist()}
+        if columns.series:
+            res['series'] = columns.series
+        res.update(meta)
+        self.send_json(200, res)
+
+    def log_message(self, format, *args):
+        if options['verbose']:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def print_usage():
+    print(_("Usage: ./server.py [OPTIONS] PATH1 [PATH2 [..]]"))
+
+options = {}
+
+optable = [
+    ('a', 'address', 'localhost', _('Address to listen on')),
+    ('P', 'port', 8000, _('Port to listen on')),
+    ('j', 'jobs', multiprocessing.cpu_count(), _('Number of worker processes')),
+    ('m', 'memo-size', MEMO_SIZE, _('Number of results kept in memory')),
+    ('v', 'verbose', False, _('Log requests'))
+    ]
+
+if __name__ == '__main__':
+    try:
+        path_list = fancyopts(sys.argv[1:], optable, options)
+    except getopt.GetoptError:
+        print_usage()
+        exit()
+    if not path_list:
+        print_usage()
+        exit()
+    server = StatsServer((options['address'], options['port']), path_list,
+                         options['jobs'], options['memo_size'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()